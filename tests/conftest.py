@@ -0,0 +1,29 @@
+import os
+import sys
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the modules import each other flat, as when run from topasTools
+sys.path.insert(0, os.path.join(ROOT, 'topasTools'))
+
+import topasBench
+
+TOPAS_CODE = os.path.join(ROOT, 'topasCode')
+
+def writeCsv(fileName, arrays):
+    """
+    csv scorer of arrays (stat -> [x,y,z] array) on the topasBench WaterBox,
+    with its parameter file next to it; TopasResults reads the arrays back exactly
+    """
+    stats = list(arrays)
+    shape = arrays[stats[0]].shape
+    parameterFile = os.path.join(os.path.dirname(fileName), 'benchBox.txt')
+    topasBench.writeParameterFile(parameterFile, shape, stats)
+    x, y, z = [a.ravel() for a in np.meshgrid(*[np.arange(n) for n in shape], indexing='ij')]
+    # rows x slowest, z fastest and mirrored, as topasBench.writeScorer
+    rows = np.column_stack([x, y, z] + [np.asarray(arrays[stat], dtype=np.float64)[:,:,::-1].ravel() for stat in stats])
+    with open(fileName, 'wt') as f:
+        f.write(''.join('# '+line+'\n' for line in topasBench.headerLines(shape, stats, os.path.basename(parameterFile))))
+        np.savetxt(f, rows, fmt=', '.join(['%d']*3 + ['%.17g']*len(stats)))
+    return fileName
@@ -0,0 +1,31 @@
+import os
+
+import numpy as np
+
+from conftest import TOPAS_CODE
+from plotting import TopasResults
+
+DOSE_BIN = os.path.join(TOPAS_CODE, 'Dose.bin')
+
+def test_binheader():
+    header = TopasResults(DOSE_BIN).header
+    assert header.topasVersion == '2.0.p3_expanded'
+    assert header.scorer == 'Dose'
+    assert header.scoredComponent == 'Phantom'
+    assert [(dim.bins, dim.size) for dim in (header.X, header.Y, header.Z)] == [(1, 50.0), (1, 50.0), (40, 0.5)]
+    assert len(header.scoredQuantity.stats) == 9
+
+def test_stats_of_each_bin_are_adjacent():
+    # read with the wrong stride the stats of a bin would not agree
+    data = TopasResults(DOSE_BIN).data
+    assert data['Sum'].shape == (1, 1, 40)
+    assert np.all(data['Histories_with_Scorer_Active'] == 1000)
+    assert np.allclose(data['Mean']*1000, data['Sum'])
+    assert np.allclose(data['Standard_Deviation']**2, data['Variance'])
+    assert np.all(data['Min'] <= data['Max'])
+    assert np.all(data['Count_in_Bin'] <= 1000)
+
+def test_binheader_or_bin():
+    a = TopasResults(DOSE_BIN).data['Sum']
+    b = TopasResults(DOSE_BIN+'header').data['Sum']
+    assert np.array_equal(a, b)
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from conftest import writeCsv
+from plotting import TopasResults
+import topasDVH
+
+@pytest.fixture(scope='module')
+def results(tmpdir_factory):
+    dose = np.random.RandomState(0).gamma(2.0, 10.0, (6, 5, 8))
+    dose[0, 0, :3] = 0.0
+    return TopasResults(writeCsv(str(tmpdir_factory.mktemp('dvh').join('dose.csv')), {'Sum':dose}), cacheDir='')
+
+def rois(results):
+    x, y, z = topasDVH.centres(results)
+    shape = results.data['Sum'].shape
+    return {'box':topasDVH.BoxROI(results, x=(-2, 2), y=(-1, 3)),
+        'cylinder':np.broadcast_to(x**2 + y**2 < 9, shape),
+        'all':topasDVH.BoxROI(results)}
+
+def test_dvh_matches_the_roi_voxels(results):
+    dose = np.asarray(results.data['Sum'])
+    voxelVolume = results.header.X.size*results.header.Y.size*results.header.Z.size
+    regions = rois(results)
+    dvhs = topasDVH.computeDVHs(results, regions, bins=500)
+    for name, roi in regions.items():
+        values = dose[roi.index] if isinstance(roi, topasDVH.BoxROI) else dose[roi]
+        dvh = dvhs[name]
+        assert values.size > 0
+        assert np.isclose(dvh.volume, values.size*voxelVolume)
+        assert np.isclose(dvh.Dmean, values.mean())
+        assert dvh.Dmax == values.max() and dvh.Dmin == values.min()
+        # at the bin edges the cumulative DVH is exact; the last edge is the
+        # maximum dose, whose voxels the histogram counts in the bin below it
+        for edge in dvh.edges[:-1:50]:
+            assert np.isclose(dvh.V(edge), 100.0*(values >= edge).mean()), (name, edge)
+
+def test_dvh_does_not_depend_on_the_slabs(results, monkeypatch):
+    whole = topasDVH.computeDVHs(results, rois(results))
+    monkeypatch.setattr(topasDVH, 'slabStep', lambda shape, axis=0: 1)
+    sliced = topasDVH.computeDVHs(results, rois(results))
+    for name in whole:
+        assert np.array_equal(whole[name].differential, sliced[name].differential)
+        assert np.isclose(whole[name].Dmean, sliced[name].Dmean)
+        assert whole[name].Dmax == sliced[name].Dmax
@@ -0,0 +1,72 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from conftest import writeCsv
+from plotting import TopasResults
+import topasGamma
+
+SHAPE = (8, 7, 6)
+
+@pytest.fixture(scope='module')
+def grids(tmpdir_factory):
+    """
+    Reference and evaluated TopasResults: a smooth dose, and the same dose
+    shifted by a bin, scaled and with noise
+    """
+    directory = tmpdir_factory.mktemp('gamma')
+    rng = np.random.RandomState(0)
+    x, y, z = np.meshgrid(*[np.linspace(-1, 1, n) for n in SHAPE], indexing='ij')
+    reference = np.exp(-(x**2 + y**2 + (z - 0.2)**2)/0.5)
+    evaluated = np.roll(reference, 1, axis=2)*1.01 + 0.02*rng.randn(*SHAPE)
+    return (TopasResults(writeCsv(str(directory.join('reference.csv')), {'Sum':reference}), cacheDir=''),
+        TopasResults(writeCsv(str(directory.join('evaluated.csv')), {'Sum':evaluated}), cacheDir=''))
+
+def bruteGamma(reference, evaluated, doseDiff, dta, searchRadius, local, threshold):
+    """
+    Gamma by trying every bin within searchRadius of every analysed voxel
+    """
+    ref = np.asarray(reference.data['Sum'])
+    ev = np.asarray(evaluated.data['Sum'])
+    sizes = np.array([reference.header.X.size, reference.header.Y.size, reference.header.Z.size])
+    reach = [int(searchRadius/size) for size in sizes]
+    gamma = np.full(ref.shape, np.nan)
+    for voxel in itertools.product(*[range(n) for n in ref.shape]):
+        if ref[voxel] < threshold/100.0*ref.max():
+            continue
+        criterion = doseDiff/100.0*(ref[voxel] if local else ref.max())
+        best = np.inf
+        ranges = [range(max(0, i - r), min(n, i + r + 1)) for i, r, n in zip(voxel, reach, ref.shape)]
+        for other in itertools.product(*ranges):
+            distance2 = np.sum(((np.array(other) - voxel)*sizes)**2)
+            if distance2 > searchRadius**2*(1 + 1E-9):
+                continue
+            best = min(best, distance2/dta**2 + ((ev[other] - ref[voxel])/criterion)**2)
+        gamma[voxel] = np.sqrt(best)
+    return gamma
+
+@pytest.mark.parametrize('local', [False, True])
+def test_gamma_matches_brute_force(grids, local):
+    reference, evaluated = grids
+    result = topasGamma.gammaAnalysis(evaluated, reference, doseDiff=2.0, dta=1.5, local=local,
+        threshold=10.0, searchRadius=4.0)
+    expected = bruteGamma(reference, evaluated, 2.0, 1.5, 4.0, local, 10.0)
+    assert np.array_equal(np.isnan(result.gamma), np.isnan(expected))
+    assert np.allclose(result.gamma, expected, rtol=1E-9, equal_nan=True)
+    assert result.analysed == np.count_nonzero(~np.isnan(expected))
+    assert np.isclose(result.passRate, 100.0*np.mean(expected[~np.isnan(expected)] <= 1))
+
+def test_gamma_on_a_pool_matches_serial(grids, monkeypatch):
+    reference, evaluated = grids
+    # several z-slabs, so the pool has work to split
+    monkeypatch.setattr(topasGamma, 'slabStep', lambda shape, axis=0: 2)
+    serial = topasGamma.gammaAnalysis(evaluated, reference, dta=1.5, subdivisions=2, processes=1)
+    pooled = topasGamma.gammaAnalysis(evaluated, reference, dta=1.5, subdivisions=2, processes=2)
+    assert np.array_equal(serial.gamma, pooled.gamma, equal_nan=True)
+
+def test_gamma_of_a_grid_with_itself_passes(grids):
+    reference, _ = grids
+    result = topasGamma.gammaAnalysis(reference, reference)
+    assert result.passRate == 100.0
+    assert np.nanmax(result.gamma) == 0.0
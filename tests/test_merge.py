@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from conftest import writeCsv
+from topasMerge import mergeResults
+
+STATS = ['Sum', 'Mean', 'Count_In_Bin', 'Variance', 'Standard_Deviation', 'Min', 'Max']
+HISTORIES = [20, 35, 50, 8, 27]
+
+def pooledStats(histories):
+    """
+    Stats TOPAS reports over per-history scores of shape (N, X, Y, Z)
+    """
+    return {'Sum':histories.sum(axis=0), 'Mean':histories.mean(axis=0),
+        'Count_In_Bin':(histories > 0).sum(axis=0).astype(np.float64),
+        'Variance':histories.var(axis=0, ddof=1), 'Standard_Deviation':histories.std(axis=0, ddof=1),
+        'Min':histories.min(axis=0), 'Max':histories.max(axis=0)}
+
+@pytest.fixture(scope='module')
+def runs(tmpdir_factory):
+    """
+    Csv files of 5 runs of one scorer, the stats of each run and the stats
+    of the histories of all runs pooled
+    """
+    directory = tmpdir_factory.mktemp('runs')
+    rng = np.random.RandomState(0)
+    scores, files, runStats = [], [], []
+    for ind, n in enumerate(HISTORIES):
+        # some histories miss some voxels, as in a real scorer
+        score = rng.gamma(2.0, 1E-10, (n, 3, 4, 5))*(rng.random_sample((n, 3, 4, 5)) < 0.7)
+        scores.append(score)
+        stats = pooledStats(score)
+        runStats.append(stats)
+        files.append(writeCsv(str(directory.join('run{}.csv'.format(ind))), dict((stat, stats[stat]) for stat in STATS)))
+    return files, runStats, pooledStats(np.concatenate(scores))
+
+@pytest.mark.parametrize('processes', [1, 3])
+def test_merge_matches_pooled_histories(runs, processes):
+    files, _, pooled = runs
+    merged = mergeResults(files, histories=HISTORIES, processes=processes)
+    for stat in STATS:
+        assert np.allclose(merged.data[stat], pooled[stat], rtol=1E-12, atol=0), stat
+
+def test_merge_of_one_run_is_the_run(runs):
+    files, runStats, _ = runs
+    merged = mergeResults(files[:1], histories=HISTORIES[:1], processes=1)
+    for stat in STATS:
+        assert np.allclose(merged.data[stat], runStats[0][stat], rtol=1E-12, atol=0), stat
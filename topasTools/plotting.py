@@ -10,7 +10,20 @@ import matplotlib.gridspec as gridspec
 
 import numpy as np
 import csv
+import os
 import re
+import warnings
+from collections import OrderedDict
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+import topasCache
+import topasSummary
+import topasPyramid
+import topasSparse
+import topasProfile
 
 TOPAS_SCORERS = [   'ProtonLET', 
                     'DoseToMedium',
@@ -33,63 +46,160 @@ TOPAS_STATS = [     'Sum',
                     'Min', 
                     'Max']
 
+# type:Name = value, with or without the type for includeFile
+PARAMETER_LINE = re.compile(r'\s*(?:(?P<type>[A-Za-z]+):)?(?P<name>[^\s=#]+)\s*=\s*(?P<value>.*)')
+# quoted strings (which may hold spaces and #) or bare words
+PARAMETER_TOKEN = re.compile(r'"[^"]*"|[^\s"]+')
+TRUE_VALUES = ('TRUE', 'T', '1')
+
+_parsedFiles = {}
+
 class TopasParameterFile:
+    """
+    Parameters of a TOPAS parameter file and the files it includes.
+
+    Files named by includeFile are read first and the including file overrides
+    them; within a file, a later definition overrides an earlier one.
+
+    parameters: full name (e.g. 'Ge/WaterBox/HLX') -> value
+    types: full name -> TOPAS type ('d', 'u', 'i', 'b', 's', 'dv', ...)
+    geometry, source: component -> {parameter: value} for Ge/ and So/
+    files: every file read, the parameter file first
+    
+    Values: d (value, unit); u float; i int; b bool; s string; 
+    dv (list, unit); uv, iv, bv, sv lists. Values that are expressions 
+    of other parameters are kept as their text.
+    """
     def __init__(self, parameterFile):
+        self.parameterFile = parameterFile
+        self.parameters = OrderedDict()
+        self.types = {}
+        self.files = []
+        with topasProfile.phase('parameterFile'):
+            self._include(parameterFile, [])
+        self._setComponents()
+
+    def _setComponents(self):
+        """
+        Group the Ge/ and So/ parameters by component into geometry and source
+        """
         self.geometry = {}
         self.source = {}
+        for name, value in self.parameters.items():
+            parts = name.split('/', 2)
+            if len(parts) < 3:
+                continue
+            if parts[0] == 'Ge':
+                self.geometry.setdefault(parts[1], {})[parts[2]] = value
+            elif parts[0] == 'So':
+                self.source.setdefault(parts[1], {})[parts[2]] = value
+
+    def _include(self, parameterFile, chain):
+        """
+        Merge parameterFile and (first) its includes into self.parameters
+        """
+        path = os.path.abspath(parameterFile)
+        if path in chain:
+            raise ValueError('includeFile loop: {}'.format(' -> '.join(chain + [path])))
+        includes, parameters = parseParameterFile(parameterFile)
+        self.files.append(parameterFile)
+        for include in includes:
+            # TOPAS resolves includes from the working directory, 
+            # fall back to the directory of the including file
+            if not os.path.isfile(include):
+                include = os.path.join(os.path.dirname(parameterFile), include)
+            self._include(include, chain + [path])
+        for name, topasType, value in parameters:
+            self.parameters[name] = value
+            self.types[name] = topasType
+
+def parseParameterFile(parameterFile):
+    """
+    (included file names, [(name, type, value), ...]) of a single parameter file,
+    memoized on its path, size and mtime
+    """
+    st = os.stat(parameterFile)
+    key = os.path.abspath(parameterFile)
+    stamp = (st.st_size, st.st_mtime)
+    if key in _parsedFiles and _parsedFiles[key][0] == stamp:
+        return _parsedFiles[key][1]
 
-        for line in open(parameterFile,'rt'):
-            # first get rid of comments
-            if '#' in line:
-                line = line[:line.index('#')]
-            
+    includes, parameters = [], []
+    lineNo = 0
+    with topasProfile.phase('parameterFile.read') as p, open(parameterFile, 'rt') as f:
+        for lineNo, line in enumerate(f, 1):
+            match = PARAMETER_LINE.match(line)
+            if match is None:
+                continue
+            tokens = []
+            for token in PARAMETER_TOKEN.findall(match.group('value')):
+                if token.startswith('#'):
+                    break
+                tokens.append(token)
+            topasType, name = match.group('type'), match.group('name')
+            if topasType is None:
+                if name.lower() == 'includefile':
+                    includes.extend(token.strip('"') for token in tokens)
+                continue
+            topasType = topasType.lower()
             try:
-                component = line.split(':')[1][:2]
-                if component == 'Ge':
-                    self._parseGeometryLine(line)
-                if component == 'So':
-                    self._parseSourceLine(line)
-            
-            except:
-                pass
-    
-    def _parseGeometryLine(self, line):
-        name = re.search(':Ge/(.*?)/',line).group(1)
-        if name not in self.geometry:
-            self.geometry[name] = {}
-        topasType = line.split(':')[0]
-        key = re.search(name+'/(.*?)=',line).group(1).strip()
-        value = self._getTopasValue(line.split('=')[1].strip(), topasType)
-        self.geometry[name][key] = value
-    
-    def _parseSourceLine(self, line):
-        name = re.search(':So/(.*?)/',line).group(1)
-        if name not in self.source:
-            self.source[name] = {}
-        topasType = line.split(':')[0]
-        key = re.search(name+'/(.*?)=',line).group(1).strip()
-        value = self._getTopasValue(line.split('=')[1].strip(), topasType)
-        self.source[name][key] = value
-
-    def _getTopasValue(self, lineVal, topasType):
-        if topasType == 's':
-            # single string; remove the qupte marks
-            return lineVal[1:-1]
-        if topasType == 'i':
-            # single integer
-            return int(lineVal)
-        if topasType == 'b':
-            # boolean like "FALSE"
-            return lineVal[1:-1].upper() == 'TRUE'
-        if topasType == 'd':
-            # double with unit. Return as tuple.
-            return (float(lineVal.split()[0]), lineVal.split()[1])
+                value = topasValue(tokens, topasType)
+            except (ValueError, IndexError):
+                warnings.warn('{}:{}: cannot read {} value of {}; kept as text'.format(
+                    parameterFile, lineNo, topasType, name))
+                value = ' '.join(tokens)
+            parameters.append((name, topasType, value))
+        p.add(bytes=st.st_size, rows=lineNo)
+
+    _parsedFiles[key] = (stamp, (includes, parameters))
+    return includes, parameters
+
+def topasValue(tokens, topasType):
+    """
+    Value of a parameter of topasType from the tokens after '='
+    """
+    if topasType == 's':
+        # single string; remove the quote marks
+        return tokens[0].strip('"')
+    if topasType == 'i':
+        return int(tokens[0])
+    if topasType == 'u':
+        return float(tokens[0])
+    if topasType == 'b':
+        # boolean like "FALSE"
+        return tokens[0].strip('"').upper() in TRUE_VALUES
+    if topasType == 'd':
+        # double with unit. Return as tuple.
+        if len(tokens) != 2:
+            raise ValueError('not a value and unit')
+        return (float(tokens[0]), tokens[1])
+    if topasType in ('sv', 'dv', 'uv', 'iv', 'bv'):
+        # vectors start with their length
+        count = int(tokens[0])
+        values = tokens[1:count+1]
+        if len(values) != count:
+            raise ValueError('vector shorter than its length')
         if topasType == 'sv':
-            # string vector. return as list of strings
-            return [val[1:-1] for val in lineVal.split()[1:]]
+            return [val.strip('"') for val in values]
+        if topasType == 'iv':
+            return [int(val) for val in values]
+        if topasType == 'bv':
+            return [val.strip('"').upper() in TRUE_VALUES for val in values]
+        values = [float(val) for val in values]
+        if topasType == 'dv':
+            return (values, tokens[count+1])
+        return values
+    raise ValueError('unknown type')
 
 class TopasHeader:
-    def __init__(self, csvFile):
+    """
+    Header of a topas csv (or .binheader) file.
+
+    With an open file f the header is read from it and f is left at the first
+    data row, so the body can be parsed without opening the file again.
+    dataOffset is that position (None for .binheader files).
+    """
+    def __init__(self, csvFile, f=None):
         self.topasVersion = ''
         self.parameterFile = ''
         self.pInfo = None
@@ -99,25 +209,71 @@ class TopasHeader:
         self.Y = readBins('')
         self.Z = readBins('')
         self.scoredQuantity = readQuantities('')
-        for line in open(csvFile,'rt'):
-            if not line.startswith('#'):
-                break
-            if line.startswith('# TOPAS Version'):
-                self.topasVersion = line.rstrip().split(': ')[1]
-            elif line.startswith('# Parameter File'):
-                self.parameterFile = line.rstrip().split(': ')[1]
-            elif line.startswith('# Results for scorer '):
-                self.scorer = line[len('# Results for scorer '):].rstrip()
-            elif line.startswith('# Scored in component'):
-                self.scoredComponent = line.rstrip().split(': ')[1]
-            elif line.startswith('# X in '):
-                self.X = readBins(line)
-            elif line.startswith('# Y in '):
-                self.Y = readBins(line)
-            elif line.startswith('# Z in '):
-                self.Z = readBins(line)
-            elif any([line.startswith('# '+scorer) for scorer in TOPAS_SCORERS]):
-                self.scoredQuantity = readQuantities(line)
+        self.dataOffset = None
+        with topasProfile.phase('header') as p:
+            if f is not None:
+                self._readLines(f, True, p)
+            else:
+                with open(csvFile,'rt') as f:
+                    self._readLines(f, not csvFile.endswith('.binheader'), p)
+
+    def _readLines(self, f, commented, p=topasProfile.NULL_PHASE):
+        """
+        commented: lines start with '# ' and the header ends at the first line 
+        that does not; in a .binheader every line is header, with or without 
+        the marks.
+        p is the profiling phase the lines are counted in.
+        """
+        pos = f.tell()
+        line = f.readline()
+        while line:
+            if commented:
+                if not line.startswith('#'):
+                    break
+                line = line[2:]
+            else:
+                line = line.lstrip('# ')
+            p.add(bytes=len(line), rows=1)
+            words = line.split(None, 1)
+            if words:
+                if words[0] in HEADER_FIELDS:
+                    HEADER_FIELDS[words[0]](self, line)
+                elif words[0] in TOPAS_SCORERS:
+                    self.scoredQuantity = readQuantities('# '+line)
+            pos = f.tell()
+            line = f.readline()
+        if commented:
+            self.dataOffset = pos
+            f.seek(pos)
+
+    def _readVersion(self, line):
+        if line.startswith('TOPAS Version'):
+            self.topasVersion = line.rstrip().split(': ')[1]
+
+    def _readParameterFile(self, line):
+        if line.startswith('Parameter File'):
+            self.parameterFile = line.rstrip().split(': ')[1]
+
+    def _readScorer(self, line):
+        if line.startswith('Results for scorer'):
+            self.scorer = line[len('Results for scorer'):].lstrip(': ').rstrip()
+
+    def _readComponent(self, line):
+        if line.startswith('Scored in component'):
+            self.scoredComponent = line.rstrip().split(': ')[1]
+
+    def _readBins(self, line):
+        if line[1:5] == ' in ':
+            setattr(self, line[0], readBins(line))
+
+# first word of a header line -> TopasHeader method reading it
+HEADER_FIELDS = {   'TOPAS':TopasHeader._readVersion,
+                    'Parameter':TopasHeader._readParameterFile,
+                    'Results':TopasHeader._readScorer,
+                    'Scored':TopasHeader._readComponent,
+                    'X':TopasHeader._readBins,
+                    'Y':TopasHeader._readBins,
+                    'Z':TopasHeader._readBins}
 
 class readQuantities:
     def __init__(self, line):
@@ -139,6 +295,8 @@ class readBins:
         self.unit = ''
         self.scale = np.linspace(0,self.size*self.bins,self.bins)
         try:
+            # TOPAS writes '1 bin  of' for a single bin
+            line = re.sub(' bins? +of ', ' bins of ', line)
             self.bins = int(line.split(' bins of ')[0].split()[-1])
             self.size = float(line.split(' bins of ')[1].split()[0]) # always work in cm
             self.unit = 'cm'
@@ -168,19 +326,32 @@ def val_cm(val):
     if val[1] == 'nm':
         return val[0]/1E8
 
-class TopasResults:
+class TopasGrid(object):
     """
-    Class to parse a topas csv file written by a scoring component
-    
-    Args: 
-        csvFile (string)
+    Header, parameter file and bin coordinates of a topas scorer file, 
+    shared by TopasResults and the streaming reader in topasStream.
     """
 
     def __init__(self, csvFile):
         self.fileName = csvFile
-        self.header = TopasHeader(csvFile)
-        self.param = TopasParameterFile(self.header.parameterFile)
-        self._read_csvFile()
+        self.header = TopasHeader(binaryPaths(csvFile)[1] if isBinaryFile(csvFile) else csvFile)
+        self._readParameterFile()
+        self._setCoordinates()
+
+    def _readParameterFile(self):
+        """
+        The header names the parameter file as TOPAS was given it, usually 
+        relative to where TOPAS ran; look next to the results file if it is 
+        not found from here.
+        """
+        parameterFile = self.header.parameterFile
+        if not os.path.isfile(parameterFile):
+            nextToResults = os.path.join(os.path.dirname(self.fileName), os.path.basename(parameterFile))
+            if os.path.isfile(nextToResults):
+                parameterFile = nextToResults
+        self.param = TopasParameterFile(parameterFile)
+
+    def _setCoordinates(self):
         #ASSUMES NO ROTATION - REVISIT LATER
         self.X_cm = np.linspace(
             val_cm(self.param.geometry[self.header.scoredComponent]['TransX']) - val_cm(self.param.geometry[self.header.scoredComponent]['HLX']), 
@@ -200,33 +371,444 @@ class TopasResults:
         self.X_cm_extent = (self.X_cm[0], self.X_cm[-1]+self.header.X.size)
         self.Y_cm_extent = (self.Y_cm[0], self.Y_cm[-1]+self.header.Y.size)
         self.Z_cm_extent = (self.Z_cm[0], self.Z_cm[-1]+self.header.Z.size)
-      
-    def _read_csvFile(self):
-        self.data = {}
-        
-        for stat in self.header.scoredQuantity.stats:
-            self.data[stat] = np.zeros((self.header.X.bins, self.header.Y.bins, self.header.Z.bins))
 
-        for line in open(self.fileName, 'rt'):
-            if not line.startswith('#'):
-                [x,y,z] = [int(i) for i in line.split(', ')[0:3]]
-                for ind,val in enumerate(line.split(', ')[3:]):
-                    self.data[self.header.scoredQuantity.stats[ind]][x,y,z] = float(val)
+    def getSlice(self, quantity, dim, index):
+        """
+        2D array of quantity with dim ('x', 'y' or 'z') fixed at bin index
+        """
+        arr = self.data[quantity]
+        if dim == 'x':
+            return arr[index,:,:]
+        if dim == 'y':
+            return arr[:,index,:]
+        return arr[:,:,index]
+
+class TopasResults(TopasGrid):
+    """
+    Class to parse a topas csv file written by a scoring component.
+    Binary output (OutputType = "binary") is read when csvFile is the
+    .bin or .binheader file of the scorer.
+    
+    Args: 
+        csvFile (string)
+    """
+
+    def __init__(self, csvFile, cacheDir=None, memoryBudget=None, progress=None, sparse=False,
+            dtype=None, layout=None):
+        """
+        cacheDir holds parsed csv results between sessions (see topasCache).
+        None uses topasCache.DEFAULT_CACHE_DIR, '' disables caching.
+
+        self.data only reads a stat when it is first used; memoryBudget 
+        (bytes) bounds how much of it stays loaded, see TopasStatData.
+
+        progress(bytesRead, rowsRead) is called after every chunk of the csv 
+        body that is parsed; an exception raised by it aborts the parse.
+
+        sparse=True keeps only the non-zero voxels of all stats, as 
+        topasSparse.SparseVolume; they are read at once and not cached.
+
+        dtype stores the stats as e.g. np.float32, or np.float16 for display
+        only (default float64; float16 overflows above 65504 and loses values 
+        below about 6e-8, which includes typical doses in Gy: a warning 
+        counts the non-zero values stored as 0 and the finite ones stored 
+        as inf). layout chooses which slices are contiguous in 
+        memory, see LAYOUTS; data is indexed [x,y,z] either way. Binary files 
+        stay memory mapped in file order unless dtype or layout is given.
+        """
+        self.fileName = csvFile
+        self.memoryBudget = memoryBudget
+        self.progress = progress
+        self.dtype = dtype
+        self.layout = layout
+        self.stamp = None
+        self.summaries = {}
+        self.pyramids = {}
+        if cacheDir is None:
+            cacheDir = topasCache.DEFAULT_CACHE_DIR
+
+        if isBinaryFile(csvFile):
+            # already memory mapped, nothing to gain from the cache
+            binFile, binHeader = binaryPaths(csvFile)
+            self.header = TopasHeader(binHeader)
+            self._readParameterFile()
+            self._setCoordinates()
+            self._read_binFile(binFile)
+            if sparse:
+                self._setData(topasSparse.fromArrays(self.data, dtype))
+        elif sparse:
+            with open(csvFile, 'rt') as f:
+                self.header = TopasHeader(csvFile, f)
+                self._readParameterFile()
+                self._setCoordinates()
+                self._setData(topasSparse.fromCsvBlocks(
+                    readCsvBlocks(f, progress=progress), self.header, dtype or np.float64))
+        elif not (cacheDir and topasCache.load(self, cacheDir)):
+            # stats read later reopen the file, which must not have changed
+            self.stamp = topasCache.fileStamp(csvFile)
+            with open(csvFile, 'rt') as f:
+                # the cache entry is parsed from where the header ends
+                self.header = TopasHeader(csvFile, f)
+                self._readParameterFile()
+                self._setCoordinates()
+                if cacheDir:
+                    try:
+                        topasCache.store(self, cacheDir, f=f)
+                    except (IOError, OSError):
+                        # unwritable cache location, parse into memory instead
+                        cacheDir = ''
+            if not cacheDir:
+                self.data = TopasStatData(
+                    self.header.scoredQuantity.stats, self._read_csvFile, memoryBudget)
+
+    @classmethod
+    def fromData(cls, grid, data, fileName=''):
+        """
+        TopasResults holding data (stat -> [x,y,z] array) on the header and
+        geometry of grid (any TopasGrid), e.g. results merged from several runs.
+        The bin coordinates are taken from grid, or worked out from its 
+        parameter file if it has none.
+        """
+        results = cls.__new__(cls)
+        results.fileName = fileName
+        results.memoryBudget = None
+        results.progress = None
+        results.dtype = None
+        results.layout = None
+        results.stamp = None
+        results.summaries = {}
+        results.pyramids = {}
+        results.header = grid.header
+        results.param = grid.param
+        if all(hasattr(grid, name) for name in topasCache.COORDINATES):
+            for name in topasCache.COORDINATES:
+                setattr(results, name, getattr(grid, name))
+        else:
+            results._setCoordinates()
+        results._setData(data)
+        return results
+
+    @property
+    def data(self):
+        """
+        TopasStatData of the stats; assigning or deleting a stat drops its 
+        summary and pyramids, see invalidate
+        """
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        data.onChange = self.invalidate
+
+    def invalidate(self, quantity=None):
+        """
+        Drop the summary and pyramids of quantity (default all stats), to be 
+        rebuilt from data on their next use. Call this after editing an array 
+        of data in place, e.g. data['Sum'] *= norm.
+        """
+        if quantity is None:
+            self.summaries = {}
+            self.pyramids = {}
+            return
+        self.summaries.pop(quantity, None)
+        for key in [key for key in self.pyramids if key[0] == quantity]:
+            del self.pyramids[key]
+
+    def _setData(self, data):
+        """
+        self.data holding the arrays in data (stat -> array), all kept loaded
+        """
+        self.data = TopasStatData([], None)
+        for stat in data:
+            self.data[stat] = data[stat]
+
+    def getSummary(self, quantity):
+        """
+        topasSummary.StatSummary of quantity (range, percentiles, histogram), 
+        computed on first use or taken from the cache
+        """
+        if quantity not in self.summaries:
+            self.summaries[quantity] = topasSummary.summarise(self.data[quantity])
+        return self.summaries[quantity]
+
+    def getPyramid(self, quantity, reduction='mean'):
+        """
+        topasPyramid.TopasPyramid of quantity; its levels are built on first use
+        """
+        if (quantity, reduction) not in self.pyramids:
+            # the pyramid takes the stat from data when it needs it, rather 
+            # than keeping it loaded past the memory budget
+            self.pyramids[quantity, reduction] = topasPyramid.TopasPyramid(
+                self.data[quantity], reduction, source=lambda: self.data[quantity])
+        return self.pyramids[quantity, reduction]
+
+    def getSlice(self, quantity, dim, index, level=0, reduction='mean'):
+        """
+        2D array of quantity with dim fixed at bin index, 
+        from pyramid level (2**level coarser in the plane) when level > 0
+        """
+        if level > 0:
+            return self.getPyramid(quantity, reduction).getSlice(dim, index, level)
+        return TopasGrid.getSlice(self, quantity, dim, index)
+
+    def _read_csvFile(self, stats=None, data=None, f=None):
+        """
+        Parse the csv body into data (stat -> [x,y,z] array) and return it.
+        Unless data is given, new arrays are allocated for stats (default all).
+        f is the csv file already open at its first data row; otherwise the 
+        file is opened and the header skipped by seeking to header.dataOffset.
+        Raises IOError if the file changed since this TopasResults read its 
+        header, rather than mixing stats of two runs.
+        """
+        if data is None:
+            data = {}
+            shape = (self.header.X.bins, self.header.Y.bins, self.header.Z.bins)
+            for stat in stats or self.header.scoredQuantity.stats:
+                data[stat] = layoutView(np.zeros(storageShape(shape, self.layout), 
+                    dtype=self.dtype or np.float64), self.layout)
+
+        with topasProfile.phase('body'):
+            if f is not None:
+                _scatterCsv(f, self.header, data, progress=self.progress)
+                return data
+            if self.stamp is not None and topasCache.fileStamp(self.fileName) != self.stamp:
+                raise IOError('{} changed since it was opened, load it again'.format(self.fileName))
+            with open(self.fileName, 'rt') as f:
+                f.seek(self.header.dataOffset)
+                _scatterCsv(f, self.header, data, progress=self.progress)
+        return data
+
+    def _read_binFile(self, binFile):
+        """
+        Memory map the raw doubles of a binary scorer.
+        TOPAS writes the stats of each bin next to each other, with x changing 
+        fastest and z slowest (unlike the csv rows, where z changes fastest), 
+        so every stat is a strided view on the file. topasCode/Dose.bin is real 
+        TOPAS output and checks the order of the stats; it has one x and y bin, 
+        so the order of the bins follows topas2numpy, which other tools read 
+        3D TOPAS dose cubes with.
+        """
+        stats = self.header.scoredQuantity.stats
+        shape = (self.header.Z.bins, self.header.Y.bins, self.header.X.bins, len(stats))
+        raw = np.memmap(binFile, dtype='<f8', mode='r')
+        if raw.size != np.prod(shape):
+            raise ValueError('{} holds {} values, header expects {}'.format(
+                binFile, raw.size, np.prod(shape)))
+        raw = raw.reshape(shape)
+
+        def views(selected):
+            # same z-flip as the csv reader
+            return dict((stat, raw[:,:,:,stats.index(stat)].transpose(2,1,0)[:,:,::-1]) 
+                for stat in selected)
+
+        def copies(selected):
+            # the strided, flipped views copied once into the requested layout
+            data = {}
+            for stat, view in views(selected).items():
+                arr = layoutView(np.empty(storageShape(view.shape, self.layout), 
+                    dtype=self.dtype or np.float64), self.layout)
+                arr[...] = view
+                if arr.dtype != view.dtype:
+                    warnCastLosses(stat, arr.dtype, castLosses(view, arr))
+                data[stat] = arr
+            return data
 
-        # This part I will need to be revisited. 
-        # TOPAS seems to start binning from the rear to front face, 
-        # not 100% sure what is happening in x and y
-        for stat in self.header.scoredQuantity.stats:
-            self.data[stat] = self.data[stat][:,:,::-1]
+        if self.dtype is None and self.layout is None:
+            self.data = TopasStatData(stats, views, self.memoryBudget)
+        else:
+            self.data = TopasStatData(stats, copies, self.memoryBudget)
 
 
-def displaySlice(topasResults, quantity, fixedDim, ax=None):
+class TopasStatData(MutableMapping):
+    """
+    Dict of stat -> [x,y,z] array that only loads a stat when it is first used.
+
+    loader(stats) returns {stat: array} for a list of stats, in one pass over the file;
+    preload() uses that to load several stats at once, a miss loads only its stat.
+    If the loaded arrays exceed memoryBudget (bytes) the least recently used ones
+    are dropped again, to be reloaded on their next use. Arrays assigned directly
+    are never dropped. onChange(stat), if set, is called after a stat is
+    assigned or deleted.
+    """
+    def __init__(self, stats, loader, memoryBudget=None):
+        self.stats = list(stats)
+        self.loader = loader
+        self.memoryBudget = memoryBudget
+        self.onChange = None
+        self._arrays = OrderedDict() # least recently used first
+        self._pinned = set()
+
+    def __getitem__(self, stat):
+        if stat not in self._arrays:
+            if stat not in self.stats:
+                raise KeyError(stat)
+            self.preload([stat])
+        arr = self._arrays.pop(stat)
+        self._arrays[stat] = arr
+        return arr
+
+    def __setitem__(self, stat, arr):
+        if stat not in self.stats:
+            self.stats.append(stat)
+        self._arrays.pop(stat, None)
+        self._arrays[stat] = arr
+        self._pinned.add(stat)
+        if self.onChange is not None:
+            self.onChange(stat)
+
+    def __delitem__(self, stat):
+        self.stats.remove(stat)
+        self._arrays.pop(stat, None)
+        self._pinned.discard(stat)
+        if self.onChange is not None:
+            self.onChange(stat)
+
+    def __iter__(self):
+        return iter(self.stats)
+
+    def __len__(self):
+        return len(self.stats)
+
+    def __contains__(self, stat):
+        return stat in self.stats
+
+    def preload(self, stats=None):
+        """
+        Load several stats with a single call of the loader
+        """
+        stats = [stat for stat in (stats or self.stats) if stat not in self._arrays]
+        if stats:
+            self._arrays.update(self.loader(stats))
+            self._enforceBudget(keep=stats)
+
+    def isLoaded(self, stat):
+        return stat in self._arrays
+
+    def unload(self, stat=None):
+        for name in ([stat] if stat else list(self._arrays)):
+            if name not in self._pinned:
+                self._arrays.pop(name, None)
+
+    def nbytes(self):
+        return sum(arr.nbytes for arr in self._arrays.values())
+
+    def _enforceBudget(self, keep=()):
+        if self.memoryBudget is None:
+            return
+        for stat in list(self._arrays):
+            if self.nbytes() <= self.memoryBudget:
+                break
+            if stat not in keep and stat not in self._pinned:
+                del self._arrays[stat]
+
+
+CSV_CHUNK_BYTES = 1 << 24
+
+# storage axis order of an [x,y,z] array in each layout:
+# 'x' is plain C order (x-slices contiguous), 'z' keeps z-slices contiguous
+LAYOUTS = {'x':(0,1,2), 'z':(2,1,0)}
+
+def storageShape(shape, layout=None):
+    """
+    Shape of the array holding an [x,y,z] array of shape in layout
+    """
+    return tuple(shape[axis] for axis in LAYOUTS[layout or 'x'])
+
+def layoutView(storage, layout=None):
+    """
+    [x,y,z] view of an array allocated with storageShape
+    """
+    # both orders are their own inverse
+    return storage.transpose(LAYOUTS[layout or 'x'])
+
+def isBinaryFile(fileName):
+    return fileName.endswith('.bin') or fileName.endswith('.binheader')
+
+def binaryPaths(fileName):
+    """
+    Return (payload, header) file names of a binary scorer given either one
+    """
+    base = fileName[:-len('header')] if fileName.endswith('.binheader') else fileName
+    return base, base+'header'
+
+def readCsvBlocks(f, chunkBytes=CSV_CHUNK_BYTES, progress=None):
+    """
+    Generator over the data rows of an open topas csv file.
+    Each block is a 2D float array of roughly chunkBytes of text,
+    one row per bin: x, y, z, then one column per reported stat.
+    progress(bytesRead, rowsRead) is called after each block, counting the body only.
+    """
+    bytesRead, rowsRead = 0, 0
+    while True:
+        with topasProfile.phase('body.parse') as p:
+            lines = f.readlines(chunkBytes)
+            if not lines:
+                return
+            # the header is already behind us, so no comment scanning per row
+            block = np.loadtxt(lines, delimiter=',', ndmin=2, comments=None)
+            if progress or p.enabled:
+                chunk = sum(len(line) for line in lines)
+                p.add(bytes=chunk, rows=len(block))
+        if progress:
+            bytesRead += chunk
+            rowsRead += len(block)
+            progress(bytesRead, rowsRead)
+        yield block
+
+def _scatterCsv(f, header, data, chunkBytes=CSV_CHUNK_BYTES, progress=None):
+    """
+    Bulk parse the body of the open csv file f into the [x,y,z] arrays in data.
+    data maps stat name -> array; stats missing from data are skipped.
+    """
+    stats = header.scoredQuantity.stats
+    columns = [(3+ind, stat, data[stat]) for ind,stat in enumerate(stats) if stat in data]
+    losses = dict((stat, (0, 0)) for stat in data)
+    zFlip = header.Z.bins - 1
+    for block in readCsvBlocks(f, chunkBytes, progress):
+        with topasProfile.phase('body.scatter') as p:
+            p.add(rows=len(block))
+            x = block[:,0].astype(np.intp)
+            y = block[:,1].astype(np.intp)
+            # This part I will need to be revisited. 
+            # TOPAS seems to start binning from the rear to front face, 
+            # not 100% sure what is happening in x and y
+            z = zFlip - block[:,2].astype(np.intp)
+            for col, stat, arr in columns:
+                if arr.dtype == block.dtype:
+                    arr[x,y,z] = block[:,col]
+                    continue
+                values = block[:,col].astype(arr.dtype)
+                losses[stat] = np.add(losses[stat], castLosses(block[:,col], values))
+                arr[x,y,z] = values
+    for stat, arr in data.items():
+        warnCastLosses(stat, arr.dtype, losses[stat])
+
+def castLosses(values, stored):
+    """
+    (non-zero values stored as 0, finite values stored as +-inf) when values 
+    were stored in a narrower dtype
+    """
+    return (int(np.count_nonzero((values != 0) & (stored == 0))),
+            int(np.count_nonzero(np.isfinite(values) & ~np.isfinite(stored))))
+
+def warnCastLosses(stat, dtype, losses):
+    if losses[0] or losses[1]:
+        warnings.warn('{} stored as {}: {} non-zero values became 0, {} became inf'.format(
+            stat, np.dtype(dtype).name, losses[0], losses[1]))
+
+
+def displaySlice(topasResults, quantity, fixedDim, ax=None, img=None, level=0):
     """
     Use pyplot imshow to display a 2D slice from the topasResults.data[quantity] array
+    (topasResults may also be a topasStream.TopasStream, read one slice at a time)
     fixedDim is tuple (dim, bin index) e.g. (x,3). 
     fixedDim[1] = None default behaviour is a central slice.
     
     ax is the image axis we update
+    img is an image returned by an earlier call; its data and axis title are 
+    replaced in place (colour limits are kept) instead of adding a new image.
+    level > 0 shows that level of the TopasResults pyramid over the same extent.
     """
     if fixedDim[0] not in ['x','y','z']:
         return
@@ -245,14 +827,12 @@ def displaySlice(topasResults, quantity, fixedDim, ax=None):
         bottom, top = topasResults.Y_cm_extent
 
         (xlabel, ylabel) = ('Z (cm)', 'Y (cm)')
-        if not fixSlice:
+        if fixSlice is None:
             fixSlice = int(0.5*topasResults.header.X.bins)
         
         title += '\n(Slice: {} = {} cm)'.format(
             fixedDim[0],
             topasResults.X_cm_cent[fixSlice])
-
-        plotData = topasResults.data[quantity][fixSlice,:,:]
     
     elif fixedDim[0] == 'y':
         left, right = topasResults.Z_cm_extent
@@ -260,14 +840,12 @@ def displaySlice(topasResults, quantity, fixedDim, ax=None):
 
         (xlabel, ylabel) = ('Z (cm)', 'X (cm)')
         
-        if not fixSlice:
+        if fixSlice is None:
             fixSlice = int(0.5*topasResults.header.Y.bins)
         
         title += '\n(Slice: {} = {} cm)'.format(
             fixedDim[0],
             topasResults.Y_cm_cent[fixSlice])
-
-        plotData = topasResults.data[quantity][:,fixSlice,:]
     
     elif fixedDim[0] == 'z':
         left, right = topasResults.X_cm_extent
@@ -275,38 +853,109 @@ def displaySlice(topasResults, quantity, fixedDim, ax=None):
 
         (xlabel, ylabel) = ('X (cm)', 'Y (cm)')
 
-        if not fixSlice:
+        if fixSlice is None:
             fixSlice = int(0.5*topasResults.header.Z.bins)
 
         title += '\n(Slice: {} = {} cm)'.format(
             fixedDim[0],
             topasResults.Z_cm_cent[fixSlice])
+    
+    with topasProfile.phase('displaySlice.slice') as p:
+        if level:
+            plotData = topasResults.getSlice(quantity, fixedDim[0], fixSlice, level)
+        else:
+            plotData = topasResults.getSlice(quantity, fixedDim[0], fixSlice)
+        p.add(bytes=plotData.nbytes, rows=1)
 
-        plotData = topasResults.data[quantity][:,:,fixSlice]
+    with topasProfile.phase('displaySlice.imshow'):
+        if img is not None:
+            img.set_data(plotData)
+            img.axes.set_title(title, fontsize=10)
+        elif ax:
+            img = ax.imshow(plotData, extent = (left, right, bottom, top), interpolation = 'none')
+            ax.set_title(title, fontsize=10); ax.set_xlabel(xlabel); ax.set_ylabel(ylabel)
     
-    img= None
-    if ax:
-        img = ax.imshow(plotData, extent = (left, right, bottom, top), interpolation = 'none')
+    return img
+
+def planeExtent(topasResults, dim):
+    """
+    imshow extent (left, right, bottom, top) in cm and axis labels of the 
+    plane displayed with dim fixed, as laid out by displaySlice
+    """
+    if dim == 'x':
+        return topasResults.Z_cm_extent + topasResults.Y_cm_extent, 'Z (cm)', 'Y (cm)'
+    if dim == 'y':
+        return topasResults.Z_cm_extent + topasResults.X_cm_extent, 'Z (cm)', 'X (cm)'
+    return topasResults.X_cm_extent + topasResults.Y_cm_extent, 'X (cm)', 'Y (cm)'
+
+def getProjection(topasResults, quantity, dim, kind='max'):
+    """
+    Maximum intensity (kind='max') or summed (kind='sum') projection 
+    of topasResults.data[quantity] along dim, laid out like getSlice
+    """
+    axis = {'x':0, 'y':1, 'z':2}[dim]
+    arr = topasResults.data[quantity]
+    if kind == 'max':
+        return np.max(arr, axis=axis)
+    if kind == 'sum':
+        return np.sum(arr, axis=axis, dtype=np.float64)
+    raise ValueError('Unknown projection {}'.format(kind))
+
+def displayProjection(topasResults, quantity, dim, kind='max', ax=None, img=None):
+    """
+    displaySlice for getProjection: a new image on ax, or img updated in place
+    (data, extent and title; colour limits are kept)
+    """
+    extent, xlabel, ylabel = planeExtent(topasResults, dim)
+    title = '{} {} [{}]\nScorer: {}; Scored component: {}\nResultsFile:{}\n({} projection along {})'.format(
+        topasResults.header.scoredQuantity.name, quantity, topasResults.header.scoredQuantity.unit,
+        topasResults.header.scorer, 
+        topasResults.header.scoredComponent,
+        topasResults.fileName,
+        {'max':'Maximum intensity', 'sum':'Summed'}[kind], dim)
+    plotData = getProjection(topasResults, quantity, dim, kind)
+
+    if img is not None:
+        img.set_data(plotData)
+        img.set_extent(extent)
+        img.axes.set_title(title, fontsize=10)
+    elif ax:
+        img = ax.imshow(plotData, extent = extent, interpolation = 'none')
         ax.set_title(title, fontsize=10); ax.set_xlabel(xlabel); ax.set_ylabel(ylabel)
-    
+
     return img
 
 
 def getBin(topasResults, dim, cmValue, discrete=True):
     """
     Return the bin number for a given cmValue  
+
+    cmValue may be a scalar or an array of cm coordinates. Bins are uniform, 
+    so this is a direct computation rather than a search. With discrete=False 
+    the fractional bin index between bin centres is returned.
+    Values outside the bin centres give None for a scalar cmValue. For an 
+    array a masked array is returned, with those values masked; under the 
+    mask a discrete index is the number of bins (nan if fractional), so 
+    indexing with the data of a masked entry raises IndexError rather than 
+    reading another voxel.
     """
-    cmCents = {'x':topasResults.X_cm_cent, 'y':topasResults.Y_cm_cent, 'z':topasResults.Z_cm_cent}
+    cmCents = {'x':topasResults.X_cm_cent, 'y':topasResults.Y_cm_cent, 'z':topasResults.Z_cm_cent}[dim]
     
-    if cmValue < cmCents[dim].min() or cmValue > cmCents[dim].max():
-        return None
+    cm = np.asarray(cmValue, dtype=np.float64)
+    outside = (cm < cmCents.min()) | (cm > cmCents.max())
+    if len(cmCents) > 1:
+        binSize = (cmCents[-1] - cmCents[0])/float(len(cmCents) - 1)
+        index = np.clip((cm - cmCents[0])/binSize, 0, len(cmCents) - 1)
     else:
-        for ind,val in enumerate(cmCents[dim][:-1]):
-            if val-cmValue * cmCents[dim][ind+1]-cmValue <= 0:
-                if discrete:
-                    return int(round(ind + (cmValue - val)/float(cmCents[dim][ind+1]-val)))
-                else:
-                    return ind + (cmValue - val)/float(cmCents[dim][ind+1]-val)
+        index = np.zeros(cm.shape)
+
+    if cm.ndim == 0:
+        if outside:
+            return None
+        return int(np.rint(index)) if discrete else float(index)
+    if discrete:
+        return np.ma.masked_array(np.where(outside, len(cmCents), np.rint(index).astype(np.intp)), mask=outside)
+    return np.ma.masked_array(np.where(outside, np.nan, index), mask=outside)
 
 def getMiddle_cm(topasResults, dim):
     cmCents = {'x':topasResults.X_cm_cent, 'y':topasResults.Y_cm_cent, 'z':topasResults.Z_cm_cent}
@@ -340,7 +989,7 @@ def orthViews(topasResults):
             #'valstep':topasResults.header.Z.size}
             }   
 
-    spos, axes, axSlide = dict(), dict(), dict()
+    spos, axes, axSlide, imgs = dict(), dict(), dict(), dict()
 
     for ind,ax in enumerate(['x','y','z']):
         axes[ax] = plt.subplot(gs[ind+3])
@@ -349,7 +998,7 @@ def orthViews(topasResults):
         spos[ax] = Slider(
             axSlide[ax], ax+' bin [cm]', **sposSetup[ax])
         startBin = getBin(topasResults,ax,sposSetup[ax]['valinit'])
-        displaySlice(topasResults, radButs.value_selected, (ax, startBin), axes[ax])
+        imgs[ax] = displaySlice(topasResults, radButs.value_selected, (ax, startBin), axes[ax])
 
     #plt.tight_layout()
 
@@ -363,17 +1012,20 @@ def orthViews(topasResults):
     def updateX(val):
         dim = 'x'
         selBin = getBin(topasResults, dim, spos[dim].val)
-        displaySlice(topasResults, radButs.value_selected, (dim, selBin), axes[dim])
+        displaySlice(topasResults, radButs.value_selected, (dim, selBin), img=imgs[dim])
+        imgs[dim].autoscale()
         fig.canvas.draw_idle()
     def updateY(val):
         dim = 'y'
         selBin = getBin(topasResults, dim, spos[dim].val)
-        displaySlice(topasResults, radButs.value_selected, (dim, selBin), axes[dim])
+        displaySlice(topasResults, radButs.value_selected, (dim, selBin), img=imgs[dim])
+        imgs[dim].autoscale()
         fig.canvas.draw_idle()
     def updateZ(val):
         dim = 'z'
         selBin = getBin(topasResults, dim, spos[dim].val)
-        displaySlice(topasResults, radButs.value_selected, (dim, selBin), axes[dim])
+        displaySlice(topasResults, radButs.value_selected, (dim, selBin), img=imgs[dim])
+        imgs[dim].autoscale()
         fig.canvas.draw_idle()
     spos['x'].on_changed(updateX)
     spos['y'].on_changed(updateY)
@@ -0,0 +1,208 @@
+"""
+Headless batch rendering of TOPAS results to PNG, e.g. for nightly QA
+
+    python topasBatch.py results/ -o png/ --stats Sum Mean --views slices mip sum
+
+Each results file (or every .csv/.bin file in a directory) gives one PNG per
+stat and view: the three central orthogonal slices, or the maximum intensity
+or summed projections along x, y and z. Files are spread over a process pool;
+every worker draws all its files on one reused figure. PNGs are named
+<file name>_<stat>_<view>.png; files sharing a name (e.g. dose.csv and 
+dose.bin, or split runs in several directories) are prefixed with their 
+relative path instead.
+"""
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import argparse
+import multiprocessing
+import os
+import sys
+import traceback
+
+import numpy as np
+
+from plotting import TopasResults, displaySlice, displayProjection, planeExtent, getBin
+
+VIEWS = ['slices', 'mip', 'sum']
+# getProjection kind of the projection views
+PROJECTIONS = {'mip':'max', 'sum':'sum'}
+RESULTS_EXTENSIONS = ('.csv', '.bin')
+
+class batchFigure:
+    """
+    Three image axes and a colorbar on an Agg canvas, drawn over and over
+    """
+    def __init__(self):
+        self.fig = Figure(figsize=(15,5))
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.axes = [self.fig.add_subplot(131), self.fig.add_subplot(132), self.fig.add_subplot(133)]
+        self.fig.subplots_adjust(left=0.05, right=0.90, top=0.62, bottom=0.1, wspace=0.3)
+        self.imgs = [None, None, None]
+        self.cbarAx = self.fig.add_axes([0.93, 0.1, 0.01, 0.52])
+        self.cbar = None
+
+_figure = None
+
+def _getFigure():
+    """
+    The batchFigure of this process
+    """
+    global _figure
+    if _figure is None:
+        _figure = batchFigure()
+    return _figure
+
+def findResults(paths):
+    """
+    Results files among paths; directories are searched (not recursively)
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                if name.endswith(RESULTS_EXTENSIONS)))
+        else:
+            files.append(path)
+    return files
+
+def outputStems(files):
+    """
+    PNG name prefix of every file: its name without extension, or where
+    that is shared with another file, its path relative to the common 
+    directory of the files, extension included ('run1_dose.csv')
+    """
+    names = [os.path.splitext(os.path.basename(fileName))[0] for fileName in files]
+    stems = list(names)
+    common = os.sep.join(os.path.commonprefix(
+        [os.path.dirname(os.path.abspath(fileName)).split(os.sep) for fileName in files])) or os.sep
+    for ind, fileName in enumerate(files):
+        if names.count(names[ind]) > 1:
+            stems[ind] = os.path.relpath(os.path.abspath(fileName), common).replace(os.sep, '_')
+    for stem in stems:
+        if stems.count(stem) > 1:
+            raise ValueError('Output names of {} collide'.format(
+                ', '.join(fileName for fileName, other in zip(files, stems) if other == stem)))
+    return stems
+
+def renderFile(fileName, stats=None, views=VIEWS, outDir='.', position=None, dpi=100, cacheDir='', stem=None):
+    """
+    Write <outDir>/<stem>_<stat>_<view>.png for every stat and view of one
+    results file and return their paths. stats=None renders all scored stats.
+    position (x, y, z in cm) places the slices, None for the central ones.
+    stem defaults to the file name without extension.
+    """
+    results = TopasResults(fileName, cacheDir=cacheDir)
+    selBins = [None, None, None]
+    if position is not None:
+        for ind, dim in enumerate(['x', 'y', 'z']):
+            selBins[ind] = getBin(results, dim, position[ind])
+            if selBins[ind] is None:
+                raise ValueError('{}: {} = {} cm is outside the scored bins'.format(fileName, dim, position[ind]))
+    fig = _getFigure()
+    if stem is None:
+        stem = os.path.splitext(os.path.basename(fileName))[0]
+    written = []
+    for stat in stats or results.header.scoredQuantity.stats:
+        if stat not in results.header.scoredQuantity.stats:
+            raise ValueError('{} has no stat {}'.format(fileName, stat))
+        for view in views:
+            for ind, dim in enumerate(['x', 'y', 'z']):
+                ax, img = fig.axes[ind], fig.imgs[ind]
+                extent = planeExtent(results, dim)[0]
+                if view == 'slices':
+                    img = displaySlice(results, stat, (dim, selBins[ind]), ax=ax, img=img)
+                    img.set_extent(extent)
+                else:
+                    img = displayProjection(results, stat, dim, PROJECTIONS[view], ax=ax, img=img)
+                ax.set_xlim(extent[:2])
+                ax.set_ylim(extent[2:])
+                fig.imgs[ind] = img
+
+            if view == 'slices':
+                summary = results.getSummary(stat)
+                clim = (summary.min, summary.max)
+            else:
+                planes = [np.asarray(img.get_array()) for img in fig.imgs]
+                clim = (min(np.nanmin(plane) for plane in planes), max(np.nanmax(plane) for plane in planes))
+            for img in fig.imgs:
+                img.set_clim(clim)
+            if fig.cbar is None:
+                fig.cbar = fig.fig.colorbar(fig.imgs[0], cax=fig.cbarAx, format='%.1e')
+                fig.cbarAx.tick_params(labelsize=8)
+            else:
+                fig.cbar.update_normal(fig.imgs[0])
+
+            pngFile = os.path.join(outDir, '{}_{}_{}.png'.format(stem, stat, view))
+            fig.fig.savefig(pngFile, dpi=dpi)
+            written.append(pngFile)
+    return written
+
+def _renderJob(args):
+    """
+    Pool worker: (file name, written PNGs, None) or (file name, [], traceback)
+    """
+    fileName, kwargs = args
+    try:
+        return fileName, renderFile(fileName, **kwargs), None
+    except Exception:
+        return fileName, [], traceback.format_exc()
+
+def renderFiles(files, processes=None, **kwargs):
+    """
+    renderFile over files on a pool of processes (None for one per core,
+    1 to run serially). Yields the results of _renderJob as files finish.
+    Raises ValueError before rendering if two files would write the same PNGs.
+    """
+    jobs = [(fileName, dict(kwargs, stem=stem)) for fileName, stem in zip(files, outputStems(files))]
+    processes = min(processes or multiprocessing.cpu_count(), max(len(jobs), 1))
+    if processes == 1:
+        for job in jobs:
+            yield _renderJob(job)
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap_unordered(_renderJob, jobs):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render TOPAS results to PNG without a display')
+    parser.add_argument('paths', nargs='+', help='results files (.csv, .bin) or directories of them')
+    parser.add_argument('-o', '--out', default='.', help='output directory')
+    parser.add_argument('--stats', nargs='+', help='stats to render (default: all scored stats)')
+    parser.add_argument('--views', nargs='+', choices=VIEWS, default=VIEWS,
+        help='central orthogonal slices, maximum intensity and/or summed projections')
+    parser.add_argument('--position', nargs=3, type=float, metavar=('X', 'Y', 'Z'),
+        help='slice position in cm (default: central slices)')
+    parser.add_argument('-j', '--processes', type=int, help='worker processes (default: one per core)')
+    parser.add_argument('--dpi', type=int, default=100)
+    parser.add_argument('--cache-dir', default='',
+        help='topasCache directory for parsed csv files (default: no cache)')
+    args = parser.parse_args(argv)
+
+    files = findResults(args.paths)
+    try:
+        outputStems(files)
+    except ValueError as err:
+        sys.stderr.write('{}\n'.format(err))
+        return 1
+    if not os.path.isdir(args.out):
+        os.makedirs(args.out)
+    failed = 0
+    for fileName, written, error in renderFiles(files, args.processes, stats=args.stats, views=args.views,
+            outDir=args.out, position=args.position, dpi=args.dpi, cacheDir=args.cache_dir):
+        if error:
+            failed += 1
+            sys.stderr.write('FAILED {}\n{}'.format(fileName, error))
+        else:
+            print('{}: {} images'.format(fileName, len(written)))
+    print('{} of {} files rendered'.format(len(files) - failed, len(files)))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,284 @@
+"""
+Benchmarks of loading and displaying TOPAS results on synthetic scorer files
+
+    python topasBench.py --sizes 1e3 1e5 1e7 --formats csv binary -o before.json
+    python topasBench.py --sizes 1e3 1e5 1e7 --formats csv binary -o after.json --compare before.json
+
+The generator writes a protonBox.txt style setup (a 10x10x20 cm WaterBox in
+a vacuum World) with a scorer of the requested number of bins, stats and
+fraction of empty voxels, as csv or binary TOPAS output. Every case is timed
+for parsing (with and without topasCache), slice extraction, in place slice
+updates, a redraw of the three views and getBin lookups, and the peak of
+traced allocations while parsing is recorded. Results are written as JSON.
+A 10^8 voxel csv of four stats takes about 9 GB of disk, which is why the default sizes
+stop at 10^7; each case is removed before the next one is written.
+"""
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from plotting import TopasResults, TOPAS_STATS, displaySlice, getBin
+
+DEFAULT_SIZES = [10**3, 10**4, 10**5, 10**6, 10**7]
+FORMATS = ['csv', 'binary']
+# half lengths (cm) of the scored WaterBox, as in protonBox.txt
+BOX_HALF_CM = (5.0, 5.0, 10.0)
+SCORER = 'BenchDoseToMedium'
+QUANTITY = ('DoseToMedium', 'Gy')
+CSV_ROW_FORMAT = '%.16g'
+GENERATE_SLAB_VOXELS = 1 << 21
+
+clock = getattr(time, 'perf_counter', time.time)
+
+def gridShape(voxels):
+    """
+    Bins (X, Y, Z) of about voxels in total, Z twice as fine as X and Y like
+    the 5x5x40 bins of the sample scorers over the 10x10x20 cm box
+    """
+    side = max(1, int(round((voxels/2.0)**(1/3.0))))
+    return (side, side, max(1, int(round(voxels/float(side*side)))))
+
+def _field(shape, stats, sparsity, seed, xs=slice(None), zs=slice(None)):
+    """
+    Synthetic dose of the bins xs, zs as [x,y,z] arrays per stat: a Bragg
+    curve along z with a Gaussian lateral profile; a fraction sparsity of
+    the voxels is empty in every stat
+    """
+    X, Y, Z = shape
+    x = ((np.arange(X) + 0.5)/X - 0.5)[xs]
+    y = (np.arange(Y) + 0.5)/Y - 0.5
+    z = ((np.arange(Z) + 0.5)/Z)[zs]
+    depth = 1.0 + 3.0*np.exp(-((z - 0.75)/0.05)**2)
+    depth[z > 0.78] *= np.exp(-((z[z > 0.78] - 0.78)/0.02)**2)
+    dose = np.exp(-(x[:,None,None]**2 + y[None,:,None]**2)/0.02)*depth[None,None,:]*1E-10
+    if sparsity:
+        # seeded per slab so files are reproducible
+        rng = np.random.RandomState(seed + (xs.start or 0) + (zs.start or 0))
+        dose[rng.random_sample(dose.shape) < sparsity] = 0.0
+    histories = 1E5
+    values = {'Sum':dose, 'Mean':dose/histories, 'Histories':np.full(dose.shape, histories),
+        'Count_In_Bin':np.where(dose > 0, 1000.0, 0.0), 'Second_Moment':(0.1*dose)**2*histories,
+        'Variance':(0.1*dose/histories)**2, 'Standard_Deviation':0.1*dose/histories,
+        'Min':0.5*dose/histories, 'Max':2.0*dose/histories}
+    return [values[stat] for stat in stats]
+
+def headerLines(shape, stats, parameterFile):
+    sizes = [2*half/bins for half, bins in zip(BOX_HALF_CM, shape)]
+    lines = ['TOPAS Version: 3.1.p3',
+             'Parameter File: {}'.format(parameterFile),
+             'Results for scorer {}'.format(SCORER),
+             'Scored in component: WaterBox']
+    for dim, bins, size in zip('XYZ', shape, sizes):
+        lines.append('{} in {} bins of {:.10g} cm'.format(dim, bins, size))
+    lines.append('{} ( {} ) : {}   '.format(QUANTITY[0], QUANTITY[1], '   '.join(stats)))
+    return lines
+
+def writeParameterFile(fileName, shape, stats):
+    with open(fileName, 'wt') as f:
+        f.write('s:Ge/World/Material  = "Vacuum"\n')
+        for dim in 'XYZ':
+            f.write('d:Ge/World/HL{}       = 2.0 m\n'.format(dim))
+        f.write('s:Ge/WaterBox/Type     = "TsBox"\n')
+        f.write('s:Ge/WaterBox/Parent   = "World"\n')
+        f.write('s:Ge/WaterBox/Material = "G4_WATER"\n')
+        for dim, half in zip('XYZ', BOX_HALF_CM):
+            f.write('d:Ge/WaterBox/HL{}      = {} cm\n'.format(dim, half))
+        for dim in 'XYZ':
+            f.write('d:Ge/WaterBox/Trans{}   = 0. cm\n'.format(dim))
+        f.write('s:Sc/{}/Quantity  = "{}"\n'.format(SCORER, QUANTITY[0]))
+        f.write('s:Sc/{}/Component = "WaterBox"\n'.format(SCORER))
+        f.write('sv:Sc/{}/Report = {} {}\n'.format(SCORER, len(stats), ' '.join('"{}"'.format(s) for s in stats)))
+        for dim, bins in zip('XYZ', shape):
+            f.write('i:Sc/{}/{}Bins = {}\n'.format(SCORER, dim, bins))
+        f.write('i:So/ProtonBeam/NumberOfHistoriesInRun   = 100000\n')
+
+def writeScorer(directory, shape, stats, sparsity=0.0, binary=False, seed=0):
+    """
+    Write a parameter file and a csv (or .bin and .binheader) scorer of shape
+    bins into directory; returns the results file name. Rows are written in
+    TOPAS order, with z mirrored as TopasResults expects.
+    """
+    parameterFile = os.path.join(directory, 'benchBox.txt')
+    writeParameterFile(parameterFile, shape, stats)
+    header = headerLines(shape, stats, os.path.basename(parameterFile))
+    X, Y, Z = shape
+
+    if not binary:
+        fileName = os.path.join(directory, SCORER+'.csv')
+        rowFormat = ', '.join(['%d']*3 + [CSV_ROW_FORMAT]*len(stats))
+        y, z = [a.ravel() for a in np.meshgrid(np.arange(Y), np.arange(Z), indexing='ij')]
+        step = max(1, GENERATE_SLAB_VOXELS//(Y*Z))
+        with open(fileName, 'wt') as f:
+            f.write(''.join('# '+line+'\n' for line in header))
+            # rows: x slowest, z fastest
+            for start in range(0, X, step):
+                xs = slice(start, min(start + step, X))
+                n = xs.stop - xs.start
+                values = [arr[:,:,::-1].reshape(-1) for arr in _field(shape, stats, sparsity, seed, xs=xs)]
+                rows = np.column_stack([np.repeat(np.arange(xs.start, xs.stop), Y*Z), np.tile(y, n), np.tile(z, n)] + values)
+                np.savetxt(f, rows, fmt=rowFormat)
+        return fileName
+
+    fileName = os.path.join(directory, SCORER+'.bin')
+    with open(os.path.join(directory, SCORER+'.binheader'), 'wt') as f:
+        f.write(''.join(line+'\n' for line in header))
+    step = max(1, GENERATE_SLAB_VOXELS//(X*Y))
+    with open(fileName, 'wb') as f:
+        # (Z,Y,X,S) little endian doubles, one slab of file z-planes at a time
+        for start in range(0, Z, step):
+            stop = min(start + step, Z)
+            slab = _field(shape, stats, sparsity, seed, zs=slice(Z - stop, Z - start))
+            np.stack([arr[:,:,::-1].transpose(2,1,0) for arr in slab], axis=-1).astype('<f8').tofile(f)
+    return fileName
+
+def _timed(func, repeat=1):
+    """
+    Mean wall time (s) of func over repeat calls
+    """
+    start = clock()
+    for _ in range(repeat):
+        func()
+    return (clock() - start)/repeat
+
+def _parse(fileName, cacheDir=''):
+    results = TopasResults(fileName, cacheDir=cacheDir)
+    results.data.preload()
+    return results
+
+def benchmarkFile(fileName, repeat=5):
+    """
+    Timings (s) and parse memory peak (bytes) for one scorer file
+    """
+    record = {'fileBytes':sum(os.path.getsize(name) for name in _files(fileName))}
+    if tracemalloc is not None:
+        tracemalloc.start()
+    start = clock()
+    results = _parse(fileName)
+    record['parse_s'] = clock() - start
+    if tracemalloc is not None:
+        record['parsePeakBytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    if fileName.endswith('.csv'):
+        cacheDir = tempfile.mkdtemp(prefix='topasBenchCache')
+        try:
+            record['cacheCold_s'] = _timed(lambda: _parse(fileName, cacheDir))
+            record['cacheWarm_s'] = _timed(lambda: TopasResults(fileName, cacheDir=cacheDir), repeat)
+        finally:
+            shutil.rmtree(cacheDir, ignore_errors=True)
+
+    stat = results.header.scoredQuantity.stats[0]
+    shape = results.data[stat].shape
+    for ind, dim in enumerate('xyz'):
+        record['slice_{}_s'.format(dim)] = _timed(
+            lambda: np.ascontiguousarray(results.getSlice(stat, dim, shape[ind]//2)), repeat)
+
+    # the three views of the viewer, drawn on an Agg canvas
+    fig = Figure(figsize=(15,5))
+    canvas = FigureCanvasAgg(fig)
+    imgs = []
+    for ind, dim in enumerate('xyz'):
+        ax = fig.add_subplot(1, 3, ind+1)
+        record['imshow_{}_s'.format(dim)] = _timed(lambda: displaySlice(results, stat, (dim, None), ax))
+        imgs.append(ax.images[-1])
+    canvas.draw()
+    for ind, dim in enumerate('xyz'):
+        record['update_{}_s'.format(dim)] = _timed(
+            lambda: displaySlice(results, stat, (dim, shape[ind]//3), img=imgs[ind]), repeat)
+    record['redraw_s'] = _timed(canvas.draw, repeat)
+
+    cm = np.random.RandomState(0).uniform(results.Z_cm_extent[0], results.Z_cm_extent[1], 10**5)
+    record['getBin_array_s'] = _timed(lambda: getBin(results, 'z', cm), repeat)
+    record['getBin_scalar_s'] = _timed(lambda: [getBin(results, 'z', value) for value in cm[:1000]], repeat)/1000
+    return record
+
+def _files(fileName):
+    if fileName.endswith('.bin'):
+        return [fileName, fileName[:-len('.bin')]+'.binheader']
+    return [fileName]
+
+def runBenchmarks(sizes=DEFAULT_SIZES, formats=FORMATS, nStats=4, sparsity=0.0, repeat=5, keep=None):
+    """
+    Generate and time one scorer per size and format. Generated files go to
+    a temporary directory, or are kept in keep.
+    """
+    stats = TOPAS_STATS[:1] + [stat for stat in TOPAS_STATS if stat not in ('Sum', 'Histories')][:nStats-1]
+    records = []
+    for voxels in sizes:
+        shape = gridShape(int(voxels))
+        for fmt in formats:
+            directory = os.path.join(keep, '{}_{}'.format(fmt, int(voxels))) if keep else tempfile.mkdtemp(prefix='topasBench')
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            try:
+                start = clock()
+                fileName = writeScorer(directory, shape, stats, sparsity, binary=(fmt == 'binary'))
+                record = {'format':fmt, 'voxels':int(np.prod(shape)), 'shape':list(shape), 'stats':stats,
+                    'sparsity':sparsity, 'generate_s':clock() - start}
+                record.update(benchmarkFile(fileName, repeat))
+                records.append(record)
+                sys.stderr.write('{format} {voxels} voxels: parse {parse_s:.3g} s\n'.format(**record))
+            finally:
+                if not keep:
+                    shutil.rmtree(directory, ignore_errors=True)
+    return {'python':platform.python_version(), 'numpy':np.__version__, 'matplotlib':matplotlib.__version__,
+        'platform':platform.platform(), 'time':time.strftime('%Y-%m-%dT%H:%M:%S'), 'results':records}
+
+def compare(old, new):
+    """
+    Lines of new/old time ratios for the cases and timings both reports share
+    """
+    oldCases = dict(((rec['format'], rec['voxels']), rec) for rec in old['results'])
+    lines = []
+    for rec in new['results']:
+        before = oldCases.get((rec['format'], rec['voxels']))
+        if before is None:
+            continue
+        ratios = ['{} {:.2f}x'.format(key[:-2], rec[key]/before[key]) for key in sorted(rec)
+            if key.endswith('_s') and before.get(key)]
+        lines.append('{} {}: {}'.format(rec['format'], rec['voxels'], ', '.join(ratios)))
+    return lines
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark TOPAS results loading and display')
+    parser.add_argument('--sizes', nargs='+', type=float, default=DEFAULT_SIZES, help='voxels per scorer')
+    parser.add_argument('--formats', nargs='+', choices=FORMATS, default=FORMATS)
+    parser.add_argument('--stats', type=int, default=4, help='stats per scorer (1-{})'.format(len(TOPAS_STATS)-1))
+    parser.add_argument('--sparsity', type=float, default=0.0, help='fraction of empty voxels')
+    parser.add_argument('--repeat', type=int, default=5, help='repeats of the fast timings')
+    parser.add_argument('--keep', help='keep the generated files in this directory')
+    parser.add_argument('-o', '--out', help='JSON report file (default: stdout)')
+    parser.add_argument('--compare', help='earlier JSON report to print time ratios against')
+    args = parser.parse_args(argv)
+
+    report = runBenchmarks(args.sizes, args.formats, args.stats, args.sparsity, args.repeat, args.keep)
+    text = json.dumps(report, indent=1, sort_keys=True)
+    if args.out:
+        with open(args.out, 'wt') as f:
+            f.write(text)
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare, 'rt') as f:
+            for line in compare(json.load(f), report):
+                sys.stderr.write(line+'\n')
+
+if __name__ == '__main__':
+    main()
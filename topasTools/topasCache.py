@@ -0,0 +1,168 @@
+"""
+On-disk cache of parsed TOPAS results.
+
+Each results file gets one entry directory in the cache, named after the hash
+of its absolute path. An entry holds one uncompressed .npy file per stat
+(memory mapped back copy-on-write on a warm load, so the arrays can be edited
+in place without touching the entry) and meta.pkl with the header, the parameter
+files, the bin coordinates and the size/mtime of every file the
+results depend on, and the topasSummary index of every stat.
+An entry is used only while none of those files changed.
+"""
+import os
+import shutil
+import pickle
+import hashlib
+import tempfile
+import time
+
+import numpy as np
+
+import topasSummary
+
+CACHE_VERSION = 5
+DEFAULT_CACHE_DIR = os.environ.get(
+    'TOPAS_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'topasTools'))
+DEFAULT_CACHE_MAX_BYTES = int(os.environ.get('TOPAS_CACHE_MAX_BYTES', 8 << 30))
+
+COORDINATES = [ 'X_cm', 'Y_cm', 'Z_cm',
+                'X_cm_cent', 'Y_cm_cent', 'Z_cm_cent',
+                'X_cm_extent', 'Y_cm_extent', 'Z_cm_extent']
+
+META_FILE = 'meta.pkl'
+
+def entryPath(cacheDir, fileName):
+    key = hashlib.sha1(os.path.abspath(fileName).encode('utf-8')).hexdigest()
+    return os.path.join(cacheDir, key)
+
+def fileStamp(fileName):
+    """
+    (absolute path, size, mtime) used to decide if a cache entry is still valid
+    """
+    st = os.stat(fileName)
+    return (os.path.abspath(fileName), st.st_size, st.st_mtime)
+
+def dependencies(topasResults):
+    return [topasResults.fileName] + topasResults.param.files
+
+def _dtype(topasResults):
+    return np.dtype(topasResults.dtype or np.float64).str
+
+def load(topasResults, cacheDir):
+    """
+    Fill topasResults from its cache entry.
+    Returns False if there is no valid entry.
+    """
+    entry = entryPath(cacheDir, topasResults.fileName)
+    metaFile = os.path.join(entry, META_FILE)
+    try:
+        with open(metaFile, 'rb') as f:
+            meta = pickle.load(f)
+        if meta['version'] != CACHE_VERSION:
+            return False
+        if (meta['dtype'], meta['layout']) != (_dtype(topasResults), topasResults.layout or 'x'):
+            return False
+        if [fileStamp(stamp[0]) for stamp in meta['dependencies']] != meta['dependencies']:
+            return False
+        stats = meta['header'].scoredQuantity.stats
+        if not all(os.path.isfile(os.path.join(entry, stat+'.npy')) for stat in stats):
+            return False
+        # mtime of the meta file orders entries for eviction
+        os.utime(metaFile, None)
+    except (IOError, OSError, EOFError, KeyError, ValueError, ImportError, AttributeError, pickle.UnpicklingError):
+        return False
+
+    topasResults.header = meta['header']
+    topasResults.param = meta['param']
+    topasResults.summaries = meta['summaries']
+    for name in COORDINATES:
+        setattr(topasResults, name, meta[name])
+
+    # imported here, plotting imports this module
+    from plotting import TopasStatData, layoutView
+    def loader(selected):
+        return dict((stat, layoutView(np.load(os.path.join(entry, stat+'.npy'), mmap_mode='c'), meta['layout'])) 
+            for stat in selected)
+    topasResults.data = TopasStatData(stats, loader, topasResults.memoryBudget)
+    return True
+
+def store(topasResults, cacheDir, maxBytes=DEFAULT_CACHE_MAX_BYTES, f=None):
+    """
+    Parse the csv body of topasResults straight into a new cache entry and
+    memory map it back as topasResults.data.
+    header, param and coordinates must already be set.
+    f is the csv file left open at its first data row by TopasHeader, if any.
+    """
+    # imported here, plotting imports this module
+    from plotting import storageShape, layoutView
+    # stamp before parsing so a file rewritten meanwhile invalidates the entry
+    stamps = [fileStamp(name) for name in dependencies(topasResults)]
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+    entry = entryPath(cacheDir, topasResults.fileName)
+    tmp = tempfile.mkdtemp(prefix='tmp', dir=cacheDir)
+    try:
+        header = topasResults.header
+        shape = storageShape((header.X.bins, header.Y.bins, header.Z.bins), topasResults.layout)
+        files, data = {}, {}
+        for stat in header.scoredQuantity.stats:
+            files[stat] = np.lib.format.open_memmap(os.path.join(tmp, stat+'.npy'), 
+                mode='w+', dtype=_dtype(topasResults), shape=shape)
+            data[stat] = layoutView(files[stat], topasResults.layout)
+        topasResults._read_csvFile(data=data, f=f)
+        summaries = {}
+        for stat in data:
+            files[stat].flush()
+            summaries[stat] = topasSummary.summarise(data[stat])
+        del files, data
+
+        meta = {'version':CACHE_VERSION, 'dependencies':stamps, 'summaries':summaries,
+                'dtype':_dtype(topasResults), 'layout':topasResults.layout or 'x',
+                'header':topasResults.header, 'param':topasResults.param}
+        for name in COORDINATES:
+            meta[name] = getattr(topasResults, name)
+        with open(os.path.join(tmp, META_FILE), 'wb') as f:
+            pickle.dump(meta, f, protocol=2)
+
+        if os.path.isdir(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+        os.rename(tmp, entry)
+    except:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+    evict(cacheDir, maxBytes, keep=entry)
+    if not load(topasResults, cacheDir):
+        raise IOError('Could not read back cache entry {}'.format(entry))
+
+def entrySize(entry):
+    return sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+
+def evict(cacheDir, maxBytes=DEFAULT_CACHE_MAX_BYTES, keep=None):
+    """
+    Remove least recently used entries until the cache holds at most maxBytes.
+    Leftovers of interrupted writes older than a day are removed too.
+    """
+    entries = []
+    for name in os.listdir(cacheDir):
+        entry = os.path.join(cacheDir, name)
+        try:
+            if name.startswith('tmp'):
+                if time.time() - os.path.getmtime(entry) > 86400:
+                    shutil.rmtree(entry, ignore_errors=True)
+                continue
+            entries.append((os.path.getmtime(os.path.join(entry, META_FILE)), entrySize(entry), entry))
+        except (IOError, OSError):
+            continue
+
+    total = sum(size for _,size,_ in entries)
+    for _,size,entry in sorted(entries):
+        if total <= maxBytes:
+            break
+        if entry == keep:
+            continue
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+def clear(cacheDir=DEFAULT_CACHE_DIR):
+    evict(cacheDir, maxBytes=0)
@@ -0,0 +1,139 @@
+"""
+Dose volume histograms of TOPAS results over box or mask shaped regions of interest
+"""
+import numpy as np
+
+from topasSummary import slabStep
+
+DVH_BINS = 1000
+
+class BoxROI:
+    """
+    Voxels whose centres lie inside x, y, z ranges (cm)
+
+    Args:
+        topasResults: any TopasGrid, for the bin centres
+        x, y, z: (low, high) cm, None for the whole axis
+    """
+    def __init__(self, topasResults, x=None, y=None, z=None):
+        self.index = []
+        for cent, limits in zip(centres(topasResults, sparse=False), (x, y, z)):
+            if limits is None:
+                self.index.append(slice(0, len(cent)))
+                continue
+            inside = np.nonzero((cent >= min(limits)) & (cent <= max(limits)))[0]
+            self.index.append(slice(inside[0], inside[-1] + 1) if len(inside) else slice(0, 0))
+        self.index = tuple(self.index)
+
+def centres(topasResults, sparse=True):
+    """
+    Bin centres (cm) of x, y, z. With sparse=True they are shaped (X,1,1),
+    (1,Y,1), (1,1,Z) so boolean ROI masks can be written as expressions,
+    e.g. x**2 + y**2 < 1 for a 1 cm radius cylinder along z.
+    """
+    cents = [topasResults.X_cm_cent, topasResults.Y_cm_cent, topasResults.Z_cm_cent]
+    if not sparse:
+        return cents
+    return np.ix_(*cents)
+
+class DVH:
+    """
+    Dose volume histogram of one region of interest.
+
+    edges: dose bin edges, from 0 to the maximum dose over all ROIs
+    differential: volume (cm3) per dose bin
+    cumulative: volume (cm3) receiving at least each edge
+    volume: ROI volume (cm3)
+    Dmean, Dmax, Dmin are exact, the rest is read from the histogram.
+    """
+    def __init__(self, edges, counts, voxelVolume, total, minimum, maximum):
+        self.edges = edges
+        self.differential = counts*voxelVolume
+        self.cumulative = np.concatenate([np.cumsum(self.differential[::-1])[::-1], [0.0]])
+        self.volume = counts.sum()*voxelVolume
+        self.Dmean = total/counts.sum() if counts.sum() else np.nan
+        self.Dmax = maximum if counts.sum() else np.nan
+        self.Dmin = minimum if counts.sum() else np.nan
+
+    def cumulativePercent(self):
+        return 100.0*self.cumulative/self.volume if self.volume else np.zeros(len(self.cumulative))
+
+    def D(self, volumePercent):
+        """
+        Minimum dose to the hottest volumePercent of the ROI, e.g. D(95)
+        """
+        if not self.volume:
+            return np.nan
+        cumulative = self.cumulativePercent()
+        return float(np.interp(volumePercent, cumulative[::-1], self.edges[::-1]))
+
+    def V(self, dose):
+        """
+        Percentage of the ROI volume receiving at least dose, e.g. V(20)
+        """
+        if not self.volume:
+            return np.nan
+        return float(np.interp(dose, self.edges, self.cumulativePercent()))
+
+def computeDVHs(topasResults, rois, quantity='Sum', bins=DVH_BINS, doseMax=None):
+    """
+    DVH of every ROI in one pass over topasResults.data[quantity], a few
+    x-slices at a time, so memory mapped volumes are never loaded whole.
+
+    Args:
+        rois (dict): name -> BoxROI or boolean [x,y,z] mask
+        bins (int): dose bins between 0 and doseMax
+        doseMax: upper dose edge, by default the maximum from the stat summary
+    Returns:
+        dict name -> DVH
+    Non-finite doses count as 0.
+    """
+    arr = topasResults.data[quantity]
+    if doseMax is None:
+        doseMax = topasResults.getSummary(quantity).max
+    doseMax = doseMax if np.isfinite(doseMax) and doseMax > 0 else 1.0
+    scale = bins/float(doseMax)
+
+    counts = dict((name, np.zeros(bins, dtype=np.int64)) for name in rois)
+    totals = dict((name, 0.0) for name in rois)
+    minima = dict((name, np.inf) for name in rois)
+    maxima = dict((name, -np.inf) for name in rois)
+    for name, roi in rois.items():
+        if not isinstance(roi, BoxROI) and np.shape(roi) != arr.shape:
+            raise ValueError('ROI {} does not match the {} grid'.format(name, arr.shape))
+
+    step = slabStep(arr.shape)
+    for start in range(0, arr.shape[0], step):
+        stop = min(start + step, arr.shape[0])
+        slab = np.asarray(arr[start:stop], dtype=np.float64)
+        if not np.isfinite(slab).all():
+            slab = np.where(np.isfinite(slab), slab, 0.0)
+        # dose bins once per slab, shared by all ROIs
+        doseBin = np.clip(slab*scale, 0, bins - 1).astype(np.intp)
+
+        for name, roi in rois.items():
+            if isinstance(roi, BoxROI):
+                lo, hi = max(roi.index[0].start, start), min(roi.index[0].stop, stop)
+                if lo >= hi:
+                    continue
+                select = (slice(lo - start, hi - start), roi.index[1], roi.index[2])
+            else:
+                select = np.asarray(roi[start:stop], dtype=bool)
+            values = slab[select]
+            if not values.size:
+                continue
+            counts[name] += np.bincount(doseBin[select].ravel(), minlength=bins)
+            totals[name] += values.sum()
+            minima[name] = min(minima[name], values.min())
+            maxima[name] = max(maxima[name], values.max())
+
+    edges = np.linspace(0.0, doseMax, bins + 1)
+    voxelVolume = topasResults.header.X.size*topasResults.header.Y.size*topasResults.header.Z.size
+    return dict((name, DVH(edges, counts[name], voxelVolume, totals[name], minima[name], maxima[name]))
+        for name in rois)
+
+def computeDVH(topasResults, roi, quantity='Sum', bins=DVH_BINS, doseMax=None):
+    """
+    computeDVHs for a single ROI
+    """
+    return computeDVHs(topasResults, {'roi':roi}, quantity, bins, doseMax)['roi']
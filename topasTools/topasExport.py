@@ -0,0 +1,312 @@
+"""
+Export of TOPAS results to a directory of compressed chunks, and import back
+
+    exportResults(results, 'dose.topas')
+    results = importResults('dose.topas')
+
+    python topasExport.py dose.csv dose.topas --chunks 32 --level 6
+
+The directory holds meta.json and one subdirectory per stat of zlib
+compressed .npy files, one per chunk of the [x,y,z] grid, named after the
+chunk index ('2.0.5.npy.zlib'). Chunks that are all zero are not written.
+Chunks are small in every direction, so a slice along any axis decompresses
+one layer of them. meta.json carries the header, the bin coordinates and the
+parameters (with the Ge/ geometry also grouped by component), so other tools
+need nothing but a JSON reader, zlib and numpy.
+"""
+import argparse
+import io
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import zlib
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from plotting import TopasGrid, TopasResults, TopasHeader, TopasParameterFile, readBins, readQuantities
+from topasCache import COORDINATES
+
+FORMAT = 'topasExport'
+FORMAT_VERSION = 1
+META_FILE = 'meta.json'
+CHUNK_SUFFIX = '.npy.zlib'
+# bins per chunk along every axis: 32**3 doubles are 256 kB raw
+CHUNK_BINS = 32
+DEFAULT_LEVEL = 6
+# decompressed chunks each imported stat keeps for repeated slicing
+CHUNK_CACHE_BYTES = 64 << 20
+
+def chunkName(index):
+    return '.'.join(str(i) for i in index) + CHUNK_SUFFIX
+
+def _headerMeta(header):
+    return OrderedDict([('topasVersion', header.topasVersion),
+        ('parameterFile', header.parameterFile),
+        ('scorer', header.scorer),
+        ('scoredComponent', header.scoredComponent),
+        ('quantity', header.scoredQuantity.name),
+        ('unit', header.scoredQuantity.unit),
+        ('stats', header.scoredQuantity.stats),
+        ('bins', OrderedDict((dim, OrderedDict([('bins', getattr(header, dim).bins),
+            ('size', getattr(header, dim).size), ('unit', getattr(header, dim).unit)]))
+            for dim in 'XYZ'))])
+
+def _writeChunk(args):
+    """
+    Compress one chunk into its file; all-zero chunks are skipped
+    """
+    fileName, chunk, level = args
+    if not chunk.any():
+        return 0
+    buf = io.BytesIO()
+    np.lib.format.write_array(buf, np.ascontiguousarray(chunk))
+    data = zlib.compress(buf.getvalue(), level)
+    with open(fileName, 'wb') as f:
+        f.write(data)
+    return len(data)
+
+def exportResults(topasResults, directory, stats=None, chunks=CHUNK_BINS, level=DEFAULT_LEVEL,
+        threads=None, overwrite=False):
+    """
+    Write stats (default all in topasResults.data) to directory.
+
+    Args:
+        chunks (int or (x, y, z)): bins per chunk
+        level (int): zlib compression level, 1 (fast) to 9 (small)
+        threads (int): chunks compressed at once, None for one per core;
+            zlib runs outside the GIL, so threads are enough
+        overwrite (bool): replace an earlier export in directory
+    Returns:
+        bytes written for the chunks
+    The stats are read one layer of chunks (along x) at a time, so memory
+    mapped or lazily loaded results are never held in memory whole. The
+    export is written next to directory and moved into place when complete.
+    """
+    directory = os.path.abspath(directory)
+    if os.path.exists(directory):
+        if not overwrite:
+            raise IOError('{} already exists'.format(directory))
+        if not os.path.isfile(os.path.join(directory, META_FILE)):
+            raise IOError('{} is not an export, not overwriting it'.format(directory))
+    stats = list(stats or topasResults.data)
+    first = topasResults.data[stats[0]]
+    shape = tuple(first.shape)
+    chunks = tuple(chunks) if np.ndim(chunks) else (chunks,)*3
+    chunks = tuple(max(1, min(c, n)) for c, n in zip(chunks, shape))
+    dtype = np.dtype(first.dtype)
+
+    tmp = tempfile.mkdtemp(prefix='.'+os.path.basename(directory)+'.tmp', dir=os.path.dirname(directory))
+    try:
+        for stat in stats:
+            os.makedirs(os.path.join(tmp, stat))
+        pool = ThreadPool(threads)
+        written = 0
+        try:
+            for x0 in range(0, shape[0], chunks[0]):
+                jobs = []
+                for stat in stats:
+                    layer = np.asarray(topasResults.data[stat][x0:x0+chunks[0]], dtype=dtype)
+                    for j, k in itertools.product(range(0, shape[1], chunks[1]), range(0, shape[2], chunks[2])):
+                        index = (x0//chunks[0], j//chunks[1], k//chunks[2])
+                        jobs.append((os.path.join(tmp, stat, chunkName(index)),
+                            layer[:, j:j+chunks[1], k:k+chunks[2]], level))
+                written += sum(pool.map(_writeChunk, jobs))
+        finally:
+            pool.close()
+            pool.join()
+        _writeMeta(topasResults, tmp, stats, shape, chunks, dtype, level)
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.rename(tmp, directory)
+    except:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return written
+
+def _writeMeta(topasResults, directory, stats, shape, chunks, dtype, level):
+
+    param = topasResults.param
+    meta = OrderedDict([('format', FORMAT), ('version', FORMAT_VERSION),
+        ('source', os.path.abspath(topasResults.fileName) if topasResults.fileName else ''),
+        ('shape', shape), ('chunks', chunks), ('dtype', dtype.str),
+        ('compressor', OrderedDict([('id', 'zlib'), ('level', level)])),
+        ('stats', stats),
+        ('header', _headerMeta(topasResults.header)),
+        ('coordinates', OrderedDict((name, np.asarray(getattr(topasResults, name)).tolist())
+            for name in COORDINATES)),
+        ('parameterFiles', param.files),
+        ('parameters', param.parameters),
+        ('types', param.types),
+        ('geometry', param.geometry)])
+    with open(os.path.join(directory, META_FILE), 'wt') as f:
+        json.dump(meta, f, indent=1)
+
+class ChunkedVolume:
+    """
+    [x,y,z] array of one exported stat, read from its chunks as needed.
+
+    Indexing with integers and slices decompresses only the chunks the
+    selection touches and returns a dense array; integer array indices read
+    the whole volume. np.asarray reads everything. The most recently used
+    chunks (up to CHUNK_CACHE_BYTES) are kept decompressed.
+    """
+    def __init__(self, directory, shape, chunks, dtype, cacheBytes=CHUNK_CACHE_BYTES):
+        self.directory = directory
+        self.shape = tuple(shape)
+        self.chunks = tuple(chunks)
+        self.ndim = 3
+        self.size = int(np.prod(self.shape))
+        self.dtype = np.dtype(dtype)
+        self.cacheBytes = cacheBytes
+        self._cache = OrderedDict() # least recently used first
+        self.nbytes = 0 # decompressed chunks held in memory
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[:,:,:]
+        return arr.astype(dtype) if dtype is not None else arr
+
+    def _chunk(self, index):
+        """
+        Decompressed chunk at index, None if it was not written (all zero)
+        """
+        if index in self._cache:
+            chunk = self._cache.pop(index)
+            self._cache[index] = chunk
+            return chunk
+        fileName = os.path.join(self.directory, chunkName(index))
+        if not os.path.isfile(fileName):
+            return None
+        with open(fileName, 'rb') as f:
+            chunk = np.lib.format.read_array(io.BytesIO(zlib.decompress(f.read())))
+        self._cache[index] = chunk
+        self.nbytes += chunk.nbytes
+        while self.nbytes > self.cacheBytes and len(self._cache) > 1:
+            self.nbytes -= self._cache.popitem(last=False)[1].nbytes
+        return chunk
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),)*(3 - len(key))
+        if any(isinstance(k, (np.ndarray, list)) for k in key):
+            return np.asarray(self)[key]
+
+        ranges, local = [], []
+        for ind, k in enumerate(key):
+            if isinstance(k, slice):
+                r = range(self.shape[ind])[k]
+            else:
+                k = int(k) + (self.shape[ind] if k < 0 else 0)
+                if not 0 <= k < self.shape[ind]:
+                    raise IndexError('index {} is out of bounds for axis {}'.format(k, ind))
+                r = range(k, k + 1)
+            ranges.append(r)
+        if any(len(r) == 0 for r in ranges):
+            return np.zeros([len(r) for k, r in zip(key, ranges) if isinstance(k, slice)], dtype=self.dtype)
+
+        # dense bounding box of the selection, filled chunk by chunk
+        lows = [min(r[0], r[-1]) for r in ranges]
+        highs = [max(r[0], r[-1]) + 1 for r in ranges]
+        box = np.zeros([hi - lo for lo, hi in zip(lows, highs)], dtype=self.dtype)
+        chunkRanges = [range(lo//c, (hi - 1)//c + 1) for lo, hi, c in zip(lows, highs, self.chunks)]
+        for index in itertools.product(*chunkRanges):
+            chunk = self._chunk(index)
+            if chunk is None:
+                continue
+            origin = [i*c for i, c in zip(index, self.chunks)]
+            start = [max(lo, o) for lo, o in zip(lows, origin)]
+            stop = [min(hi, o + n) for hi, o, n in zip(highs, origin, chunk.shape)]
+            box[tuple(slice(a - lo, b - lo) for a, b, lo in zip(start, stop, lows))] = \
+                chunk[tuple(slice(a - o, b - o) for a, b, o in zip(start, stop, origin))]
+
+        for k, r, lo in zip(key, ranges, lows):
+            if isinstance(k, slice):
+                stop = r.stop - lo
+                local.append(slice(r.start - lo, stop if stop >= 0 else None, r.step))
+            else:
+                local.append(r.start - lo)
+        return box[tuple(local)]
+
+def readMeta(directory):
+    with open(os.path.join(directory, META_FILE), 'rt') as f:
+        meta = json.load(f, object_pairs_hook=OrderedDict)
+    if meta.get('format') != FORMAT:
+        raise ValueError('{} is not a {} directory'.format(directory, FORMAT))
+    if meta['version'] > FORMAT_VERSION:
+        raise ValueError('{} was written by a newer version ({})'.format(directory, meta['version']))
+    return meta
+
+def importResults(directory, cacheBytes=CHUNK_CACHE_BYTES):
+    """
+    TopasResults of an export. Its data holds a ChunkedVolume per stat,
+    so slices, summaries and pyramids read only the chunks they need;
+    cacheBytes bounds the decompressed chunks kept per stat.
+    """
+    meta = readMeta(directory)
+
+    grid = TopasGrid.__new__(TopasGrid)
+    grid.header = header = TopasHeader.__new__(TopasHeader)
+    info = meta['header']
+    header.topasVersion = info['topasVersion']
+    header.parameterFile = info['parameterFile']
+    header.pInfo = None
+    header.scorer = info['scorer']
+    header.scoredComponent = info['scoredComponent']
+    header.dataOffset = None
+    header.scoredQuantity = readQuantities('')
+    header.scoredQuantity.name = info['quantity']
+    header.scoredQuantity.unit = info['unit']
+    header.scoredQuantity.stats = list(info['stats'])
+    for dim, bins in info['bins'].items():
+        axis = readBins('')
+        axis.bins, axis.size, axis.unit = bins['bins'], bins['size'], bins['unit']
+        axis.scale = np.linspace(0, axis.size*axis.bins, axis.bins)
+        setattr(header, dim, axis)
+
+    grid.param = param = TopasParameterFile.__new__(TopasParameterFile)
+    param.parameterFile = meta['parameterFiles'][0] if meta['parameterFiles'] else ''
+    param.files = list(meta['parameterFiles'])
+    param.types = dict(meta['types'])
+    param.parameters = OrderedDict()
+    for name, value in meta['parameters'].items():
+        # JSON has no tuples: d and dv values are (value, unit)
+        if param.types.get(name) in ('d', 'dv') and isinstance(value, list):
+            value = tuple(value)
+        param.parameters[name] = value
+    param._setComponents()
+    # as exported: the geometry may hold expressions _setCoordinates cannot evaluate
+    for name in COORDINATES:
+        value = meta['coordinates'][name]
+        setattr(grid, name, tuple(value) if name.endswith('_extent') else np.array(value))
+
+    data = OrderedDict((stat, ChunkedVolume(os.path.join(directory, stat), meta['shape'], meta['chunks'],
+        meta['dtype'], cacheBytes)) for stat in meta['stats'])
+    return TopasResults.fromData(grid, data, directory)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export TOPAS results to compressed chunks')
+    parser.add_argument('results', help='results file (.csv, .bin)')
+    parser.add_argument('out', help='export directory')
+    parser.add_argument('--stats', nargs='+', help='stats to export (default: all scored stats)')
+    parser.add_argument('--chunks', nargs='+', type=int, default=[CHUNK_BINS], help='bins per chunk, one or x y z')
+    parser.add_argument('--level', type=int, default=DEFAULT_LEVEL, help='zlib level 1-9')
+    parser.add_argument('-j', '--threads', type=int, help='compression threads (default: one per core)')
+    parser.add_argument('--overwrite', action='store_true', help='replace an earlier export')
+    parser.add_argument('--cache-dir', default='',
+        help='topasCache directory for parsed csv files (default: no cache)')
+    args = parser.parse_args(argv)
+
+    results = TopasResults(args.results, cacheDir=args.cache_dir)
+    chunks = args.chunks[0] if len(args.chunks) == 1 else args.chunks
+    written = exportResults(results, args.out, args.stats, chunks, args.level, args.threads, args.overwrite)
+    print('{}: {:.1f} MB in {}'.format(args.results, written/1E6, args.out))
+
+if __name__ == '__main__':
+    main()
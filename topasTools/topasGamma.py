@@ -0,0 +1,133 @@
+"""
+Gamma analysis of a TOPAS dose grid against a reference grid
+"""
+import multiprocessing
+
+import numpy as np
+
+from topasSummary import slabStep
+
+class GammaResult:
+    """
+    gamma: [x,y,z] gamma index, nan where the reference is below the threshold
+    passRate: percentage of the analysed voxels with gamma <= 1
+    analysed: number of voxels above the threshold
+    """
+    def __init__(self, gamma, doseDiff, dta, local, threshold):
+        self.gamma = gamma
+        self.doseDiff = doseDiff
+        self.dta = dta
+        self.local = local
+        self.threshold = threshold
+        analysed = ~np.isnan(gamma)
+        self.analysed = int(analysed.sum())
+        self.passRate = 100.0*np.count_nonzero(gamma[analysed] <= 1.0)/self.analysed if self.analysed else np.nan
+
+def _offsets(binSize, dta, searchRadius, subdivisions):
+    """
+    Search offsets (voxels, per axis) within searchRadius, sorted by their
+    distance term (distance/dta)**2, and the padding (voxels) they need
+    """
+    # the tolerance keeps offsets exactly on the search radius
+    steps = [int(np.floor(searchRadius/size*subdivisions*(1 + 1e-9))) for size in binSize]
+    grids = np.meshgrid(*[np.arange(-n, n + 1)/float(subdivisions) for n in steps], indexing='ij')
+    offsets = np.stack([grid.ravel() for grid in grids], axis=1)
+    distance2 = ((offsets*np.asarray(binSize))**2).sum(axis=1)/dta**2
+    keep = distance2 <= (searchRadius/dta)**2*(1 + 1e-9)
+    order = np.argsort(distance2[keep], kind='mergesort')
+    pad = [int(np.ceil(n/float(subdivisions))) for n in steps]
+    return offsets[keep][order], distance2[keep][order], pad
+
+def _shifted(padded, pad, shape, offset):
+    """
+    Evaluated dose at every reference voxel moved by offset (voxels), trilinear
+    between voxels for fractional offsets; nan beyond the evaluated grid
+    """
+    lower = np.floor(offset).astype(int)
+    fraction = offset - lower
+    result = 0.0
+    for corner in range(8):
+        upper = [(corner >> ind) & 1 for ind in range(3)]
+        weight = 1.0
+        for ind in range(3):
+            weight *= fraction[ind] if upper[ind] else 1.0 - fraction[ind]
+        if weight == 0.0:
+            continue
+        start = [pad[ind] + lower[ind] + upper[ind] for ind in range(3)]
+        result = result + weight*padded[start[0]:start[0]+shape[0], start[1]:start[1]+shape[1], start[2]:start[2]+shape[2]]
+    return result
+
+def _gammaSlab(args):
+    """
+    Gamma of one z-slab of the reference; evaluated is the matching slab
+    of the nan padded evaluated grid
+    """
+    reference, evaluated, pad, offsets, distance2, criterion, cutoff = args
+    shape = reference.shape
+    analysed = reference >= cutoff
+    gamma2 = np.full(shape, np.inf)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for offset, distanceTerm in zip(offsets, distance2):
+            # offsets are sorted, so nothing further away can lower gamma
+            if not analysed.any() or distanceTerm >= gamma2[analysed].max():
+                break
+            doseTerm = ((_shifted(evaluated, pad, shape, offset) - reference)/criterion)**2
+            gamma2 = np.fmin(gamma2, distanceTerm + doseTerm)
+    gamma = np.sqrt(gamma2)
+    gamma[~analysed] = np.nan
+    return gamma
+
+def gammaAnalysis(evaluated, reference, quantity='Sum', doseDiff=3.0, dta=0.3, local=False,
+        threshold=10.0, searchRadius=None, subdivisions=1, processes=1):
+    """
+    Gamma index of evaluated against reference, two TopasResults on the same bins.
+
+    Args:
+        doseDiff (float): dose difference criterion, percent of the reference
+            maximum (global) or of the reference voxel (local=True)
+        dta (float): distance to agreement (cm)
+        threshold (float): reference voxels below this percentage of the
+            reference maximum are not analysed
+        searchRadius (float): cm searched around each voxel, default 3*dta
+        subdivisions (int): search steps per bin; above 1 the evaluated dose
+            is interpolated between bins
+        processes (int): pool size for the z-slabs, None for one per core
+    Returns:
+        GammaResult
+    """
+    if reference.data[quantity].shape != evaluated.data[quantity].shape:
+        raise ValueError('Evaluated and reference {} are on different grids'.format(quantity))
+    binSize = [reference.header.X.size, reference.header.Y.size, reference.header.Z.size]
+    evalSize = [evaluated.header.X.size, evaluated.header.Y.size, evaluated.header.Z.size]
+    if not np.allclose(binSize, evalSize):
+        raise ValueError('Evaluated and reference bins differ in size')
+    searchRadius = 3.0*dta if searchRadius is None else searchRadius
+    offsets, distance2, pad = _offsets(binSize, dta, searchRadius, subdivisions)
+
+    refArr = np.asarray(reference.data[quantity], dtype=np.float64)
+    refMax = np.nanmax(refArr)
+    cutoff = threshold/100.0*refMax
+    padded = np.pad(np.asarray(evaluated.data[quantity], dtype=np.float64),
+        [(n, n) for n in pad], mode='constant', constant_values=np.nan)
+
+    step = slabStep(refArr.shape, axis=2)
+    jobs = []
+    for start in range(0, refArr.shape[2], step):
+        stop = min(start + step, refArr.shape[2])
+        ref = refArr[:,:,start:stop]
+        if local:
+            criterion = np.maximum(doseDiff/100.0*ref, np.finfo(np.float64).tiny)
+        else:
+            criterion = doseDiff/100.0*refMax
+        jobs.append((ref, padded[:,:,start:stop + 2*pad[2]], pad, offsets, distance2, criterion, cutoff))
+
+    if processes == 1 or len(jobs) == 1:
+        slabs = [_gammaSlab(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            slabs = pool.map(_gammaSlab, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    return GammaResult(np.concatenate(slabs, axis=2), doseDiff, dta, local, threshold)
@@ -0,0 +1,172 @@
+"""
+Merge TOPAS results of split/parallel runs of the same scorer
+"""
+import multiprocessing
+
+import numpy as np
+
+from plotting import TopasGrid, TopasHeader, TopasResults, isBinaryFile, binaryPaths
+
+def historiesFromParameters(param):
+    """
+    Total NumberOfHistoriesInRun over all sources of a TopasParameterFile
+    """
+    return sum(source['NumberOfHistoriesInRun'] for source in param.source.values()
+        if 'NumberOfHistoriesInRun' in source)
+
+def _partial(fileName, histories=None, cacheDir=''):
+    """
+    Running statistics of one results file: history count N, Sum, Mean,
+    M2 (sum of squared deviations from the mean), Count_In_Bin, Min, Max.
+    TOPAS reports Variance = M2/(N-1) and Standard_Deviation = sqrt(Variance).
+    """
+    results = TopasResults(fileName, cacheDir=cacheDir)
+    data = results.data
+    stats = results.header.scoredQuantity.stats
+
+    if 'Histories' in stats:
+        N = np.array(data['Histories'], dtype=np.float64)
+    elif histories is not None:
+        N = float(histories)
+    else:
+        N = float(historiesFromParameters(results.param))
+    if np.all(N == 0):
+        raise ValueError('No history count for {}; pass histories='.format(fileName))
+
+    part = {'N':N}
+    for stat in ['Sum', 'Count_In_Bin', 'Min', 'Max']:
+        if stat in stats:
+            part[stat] = np.array(data[stat], dtype=np.float64)
+
+    if 'Mean' in stats:
+        part['Mean'] = np.array(data['Mean'], dtype=np.float64)
+    elif 'Sum' in stats:
+        part['Mean'] = part['Sum']/N
+
+    with np.errstate(invalid='ignore'):
+        if 'Second_Moment' in stats:
+            part['M2'] = np.array(data['Second_Moment'], dtype=np.float64)
+        elif 'Variance' in stats:
+            part['M2'] = np.array(data['Variance'], dtype=np.float64)*(N - 1)
+        elif 'Standard_Deviation' in stats:
+            part['M2'] = np.array(data['Standard_Deviation'], dtype=np.float64)**2*(N - 1)
+    if 'M2' in part and 'Mean' not in part:
+        raise ValueError('{} reports a spread but no Mean or Sum to merge it with'.format(fileName))
+    return part
+
+def _combine(a, b):
+    """
+    Pairwise merge of two partials (Chan et al. parallel variance update)
+    """
+    N = a['N'] + b['N']
+    part = {'N':N}
+    for stat in ['Sum', 'Count_In_Bin']:
+        if stat in a:
+            part[stat] = a[stat] + b[stat]
+    if 'Min' in a:
+        part['Min'] = np.minimum(a['Min'], b['Min'])
+    if 'Max' in a:
+        part['Max'] = np.maximum(a['Max'], b['Max'])
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if 'Mean' in a:
+            delta = b['Mean'] - a['Mean']
+            part['Mean'] = np.where(N > 0, a['Mean'] + delta*(b['N']/N), 0.0)
+        if 'M2' in a:
+            part['M2'] = a['M2'] + b['M2'] + np.where(N > 0, delta**2*(a['N']*b['N']/N), 0.0)
+    return part
+
+def _pairwise(parts):
+    """
+    Reduce partials as a balanced tree, combining each one as it arrives
+    (a binary counter), so at most about log2(n) partials are held at once
+    """
+    stack = [] # (level, partial), levels decreasing
+    for part in parts:
+        level = 0
+        while stack and stack[-1][0] == level:
+            part = _combine(stack.pop()[1], part)
+            level += 1
+        stack.append((level, part))
+    part = stack.pop()[1]
+    while stack:
+        part = _combine(stack.pop()[1], part)
+    return part
+
+def _mergeGroup(args):
+    files, histories, cacheDir = args
+    # a generator, so each file is folded in before the next one is loaded
+    return _pairwise(_partial(name, hist, cacheDir) for name,hist in zip(files, histories))
+
+def _finalise(part, stats):
+    N = part['N']
+    data = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for stat in stats:
+            if stat in ('Sum', 'Mean', 'Count_In_Bin', 'Min', 'Max'):
+                data[stat] = part[stat]
+            elif stat == 'Histories':
+                data[stat] = N
+            elif stat == 'Second_Moment':
+                data[stat] = part['M2']
+            elif stat == 'Variance':
+                data[stat] = np.where(N > 1, part['M2']/(N - 1), 0.0)
+            elif stat == 'Standard_Deviation':
+                data[stat] = np.sqrt(np.where(N > 1, part['M2']/(N - 1), 0.0))
+    shape = np.shape(part.get('Sum', part.get('Mean')))
+    for stat in data:
+        data[stat] = np.broadcast_to(data[stat], shape).copy()
+    return data
+
+def checkGeometry(files):
+    """
+    Raise ValueError unless all files score the same quantity on the same bins
+    """
+    def signature(fileName):
+        header = TopasHeader(binaryPaths(fileName)[1] if isBinaryFile(fileName) else fileName)
+        return (header.scoredComponent, header.scoredQuantity.name, header.scoredQuantity.stats,
+            [(dim.bins, dim.size) for dim in (header.X, header.Y, header.Z)])
+    reference = signature(files[0])
+    for fileName in files[1:]:
+        if signature(fileName) != reference:
+            raise ValueError('{} does not match the geometry of {}'.format(fileName, files[0]))
+
+def mergeResults(files, histories=None, processes=None, cacheDir=''):
+    """
+    Combine results files of the same scorer (e.g. runs with different seeds)
+    into one TopasResults, as if they were a single run.
+
+    Files are loaded on a process pool; each worker folds its share of the
+    files in pairwise as it loads them, holding only a few at a time, and the
+    per-worker results are reduced pairwise again.
+
+    Args:
+        files (list of strings)
+        histories (list): histories per file, only needed when the files do not
+            report Histories and their parameter file has no NumberOfHistoriesInRun
+        processes (int): pool size, None for one per core, 1 to run serially
+        cacheDir: topasCache directory for the inputs; by default they are not
+            cached, a merge reads every file once
+    """
+    files = list(files)
+    if not files:
+        raise ValueError('No files to merge')
+    checkGeometry(files)
+    if histories is None:
+        histories = [None]*len(files)
+
+    processes = min(processes or multiprocessing.cpu_count(), len(files))
+    groups = [(files[ind::processes], histories[ind::processes], cacheDir) for ind in range(processes)]
+    if processes == 1:
+        parts = [_mergeGroup(group) for group in groups]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            parts = pool.map(_mergeGroup, groups)
+        finally:
+            pool.close()
+            pool.join()
+
+    grid = TopasGrid(files[0])
+    data = _finalise(_pairwise(parts), grid.header.scoredQuantity.stats)
+    return TopasResults.fromData(grid, data, fileName=files[0])
@@ -0,0 +1,239 @@
+"""
+Opt-in timing of the phases of reading and drawing TOPAS results
+
+    import topasProfile
+    profile = topasProfile.enable(allocations=True)
+    results = TopasResults('dose.csv', cacheDir='')
+    results.data.preload()
+    print(profile)
+    topasProfile.disable()
+
+Instrumented code wraps each phase in `with topasProfile.phase(name) as p:`
+and may count what it processed with p.add(bytes, rows). While profiling is
+disabled phase() returns a shared do-nothing phase, so the cost is one call
+per phase; counts that are expensive to work out are guarded by p.enabled.
+
+Phases nest: a phase started inside another (on the same thread) is also
+part of the outer one's time and allocations.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+clock = getattr(time, 'perf_counter', time.time)
+
+class PhaseStats:
+    """
+    Totals of one phase name: calls, seconds (wall time), bytes and rows
+    processed, and peakBytes, the largest increase in traced allocations
+    during one call (None unless allocations are traced)
+    """
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.rows = 0
+        self.peakBytes = None
+
+    def copy(self):
+        stats = PhaseStats(self.name)
+        stats.__dict__.update(self.__dict__)
+        return stats
+
+    def asDict(self):
+        return dict(self.__dict__)
+
+    def __repr__(self):
+        text = '{}: {} calls, {:.4g} s'.format(self.name, self.calls, self.seconds)
+        if self.bytes:
+            text += ', {:.4g} MB'.format(self.bytes/1E6)
+        if self.rows:
+            text += ', {} rows'.format(self.rows)
+        if self.peakBytes is not None:
+            text += ', peak {:.4g} MB'.format(self.peakBytes/1E6)
+        return text
+
+class ProfileReport:
+    """
+    Per-phase totals, in the order the phases first ran.
+
+    phases: phase name -> PhaseStats
+    snapshot() and since(snapshot) give the report of what ran in between,
+    e.g. a single load or redraw.
+    """
+    def __init__(self, allocations=False):
+        self.allocations = allocations
+        self.phases = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _record(self, phase, seconds, peakBytes):
+        with self._lock:
+            stats = self.phases.get(phase.name)
+            if stats is None:
+                stats = self.phases[phase.name] = PhaseStats(phase.name)
+            stats.calls += 1
+            stats.seconds += seconds
+            stats.bytes += phase.bytes
+            stats.rows += phase.rows
+            if peakBytes is not None:
+                stats.peakBytes = max(stats.peakBytes or 0, peakBytes)
+
+    def reset(self):
+        with self._lock:
+            self.phases = OrderedDict()
+
+    def snapshot(self):
+        with self._lock:
+            return OrderedDict((name, stats.copy()) for name, stats in self.phases.items())
+
+    def since(self, snapshot):
+        """
+        ProfileReport of the calls made after snapshot was taken;
+        peakBytes stays the largest of any call
+        """
+        report = ProfileReport(self.allocations)
+        for name, stats in self.snapshot().items():
+            before = snapshot.get(name)
+            if before is not None:
+                if stats.calls == before.calls:
+                    continue
+                stats.calls -= before.calls
+                stats.seconds -= before.seconds
+                stats.bytes -= before.bytes
+                stats.rows -= before.rows
+            report.phases[name] = stats
+        return report
+
+    def asDict(self):
+        return OrderedDict((name, stats.asDict()) for name, stats in self.phases.items())
+
+    def summary(self, names=None):
+        """
+        One line of the time of the phases in names (default all), for a
+        status bar
+        """
+        return ', '.join('{} {:.3g} ms'.format(name, 1E3*self.phases[name].seconds)
+            for name in names or self.phases if name in self.phases)
+
+    def __str__(self):
+        return '\n'.join(repr(stats) for stats in self.phases.values())
+
+class Phase:
+    """
+    Context manager timing one call of a phase into its ProfileReport
+    """
+    enabled = True
+
+    def __init__(self, report, name):
+        self.report = report
+        self.name = name
+        self.bytes = 0
+        self.rows = 0
+        self._peak = 0
+
+    def add(self, bytes=0, rows=0):
+        self.bytes += bytes
+        self.rows += rows
+
+    def __enter__(self):
+        self._stack = self.report._stack()
+        self._traced = self.report.allocations and tracemalloc is not None and tracemalloc.is_tracing()
+        if self._traced:
+            current, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                # the outer phase keeps the peak it reached so far
+                outer = self._stack[-1]
+                outer._peak = max(outer._peak, peak)
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            self._start = current
+        self._stack.append(self)
+        self._time = clock()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = clock() - self._time
+        self._stack.pop()
+        peakBytes = None
+        if self._traced and tracemalloc.is_tracing():
+            peak = max(tracemalloc.get_traced_memory()[1], self._peak)
+            peakBytes = max(peak - self._start, 0)
+            if self._stack:
+                outer = self._stack[-1]
+                outer._peak = max(outer._peak, peak)
+        self.report._record(self, seconds, peakBytes)
+        return False
+
+class NullPhase:
+    """
+    The phase handed out while profiling is disabled
+    """
+    enabled = False
+
+    def add(self, bytes=0, rows=0):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_PHASE = NullPhase()
+_report = None
+_startedTracing = False
+
+def phase(name):
+    """
+    Context manager timing name in the current report, if profiling is enabled
+    """
+    if _report is None:
+        return NULL_PHASE
+    return _report.phase(name)
+
+def enable(allocations=False):
+    """
+    Start profiling into a new ProfileReport and return it. allocations=True
+    traces allocations with tracemalloc (Python 3) for the peak of each phase,
+    which slows allocation heavy code down noticeably; peaks are approximate
+    while phases run on several threads at once.
+    """
+    global _report, _startedTracing
+    disable()
+    _report = ProfileReport(allocations and tracemalloc is not None)
+    if _report.allocations and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _startedTracing = True
+    return _report
+
+def disable():
+    """
+    Stop profiling; returns the report that was being filled, if any
+    """
+    global _report, _startedTracing
+    report, _report = _report, None
+    if _startedTracing:
+        tracemalloc.stop()
+        _startedTracing = False
+    return report
+
+def current():
+    """
+    The ProfileReport being filled, None while profiling is disabled
+    """
+    return _report
@@ -0,0 +1,116 @@
+"""
+Multi-resolution (mip-style) pyramid of a TOPAS stat cube for display
+"""
+import warnings
+
+import numpy as np
+
+from topasSummary import slabStep
+
+REDUCTIONS = {'mean':np.nanmean, 'max':np.nanmax}
+
+# axes of an [x,y,z] array that lie in the plane of a slice through dim
+PLANE_AXES = {'x':(1,2), 'y':(0,2), 'z':(0,1)}
+
+def _halve(arr, reduction, axes):
+    """
+    Downsample an [x,y,z] array 2x along axes, a few x-slices at a time.
+    Odd axes are padded with nan, so the last bin reduces the real voxels only.
+    Reduced in float64 and stored in the float type of arr (float64 for ints).
+    """
+    reduce = REDUCTIONS[reduction]
+    shape = [(n + 1)//2 if ind in axes else n for ind, n in enumerate(arr.shape)]
+    out = np.empty(shape, dtype=np.promote_types(arr.dtype, np.float16))
+    # whole pairs of x-slices when x is reduced
+    factor = 2 if 0 in axes else 1
+    step = factor*slabStep(arr.shape)
+    for start in range(0, arr.shape[0], step):
+        slab = np.asarray(arr[start:start+step], dtype=np.float64)
+        pad = [(0, n % 2 if ind in axes else 0) for ind, n in enumerate(slab.shape)]
+        if any(after for _,after in pad):
+            slab = np.pad(slab, pad, mode='constant', constant_values=np.nan)
+        blockShape, reduced = [], []
+        for ind, n in enumerate(slab.shape):
+            if ind in axes:
+                blockShape += [n//2, 2]
+                reduced.append(len(blockShape) - 1)
+            else:
+                blockShape.append(n)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            block = reduce(slab.reshape(blockShape), axis=tuple(reduced))
+        out[start//factor:start//factor+block.shape[0]] = block
+    return out
+
+class TopasPyramid:
+    """
+    Levels of one stat cube for the slices through each dim: level k of dim
+    is 2**k times coarser in the plane of the slice (reduced by 'mean' or
+    'max') and keeps every bin of dim, so a slice of it is always one real
+    bin. A level is computed from the one below it the first time it is
+    asked for, and kept. Level 0 is the stat itself: with source it is not
+    held here, so a TopasStatData memory budget still applies to it; without,
+    arr is kept until every dim has built its first level.
+
+    Args:
+        arr: [x,y,z] array, e.g. topasResults.data['Sum']
+        reduction (string): 'mean' or 'max'
+        source: callable returning arr again, e.g. lambda: topasResults.data['Sum'],
+            called whenever a dim builds its first level
+    """
+    def __init__(self, arr, reduction='mean', source=None):
+        if reduction not in REDUCTIONS:
+            raise ValueError('Unknown reduction {}'.format(reduction))
+        self.reduction = reduction
+        self.shape = arr.shape
+        self.levels = dict((dim, [None]) for dim in PLANE_AXES)
+        self._source = source
+        self._base = arr if source is None else None
+
+    def maxLevel(self, dim):
+        """
+        Level of dim whose slices are a single voxel
+        """
+        plane = max(self.shape[ind] for ind in PLANE_AXES[dim])
+        return int(np.ceil(np.log2(plane))) if plane > 1 else 0
+
+    def level(self, k, dim):
+        """
+        Level k >= 1 of dim, clipped to maxLevel(dim) (but at least 1)
+        """
+        k = max(1, min(k, self.maxLevel(dim)))
+        levels = self.levels[dim]
+        while len(levels) <= k:
+            if len(levels) > 1:
+                below = levels[-1]
+            elif self._source is not None:
+                below = self._source()
+            else:
+                below = self._base
+            levels.append(_halve(below, self.reduction, PLANE_AXES[dim]))
+        if all(len(levels) > 1 for levels in self.levels.values()):
+            # every dim has its first level, the stat itself is not needed
+            self._base = None
+        return levels[k]
+
+    def getSlice(self, dim, index, k):
+        """
+        Slice of level k through full resolution bin index of dim.
+        Shown over the full resolution extent, it is off by at most one
+        coarse bin at the far edge of odd sized axes.
+        """
+        arr = self.level(k, dim)
+        if dim == 'x':
+            return arr[index,:,:]
+        if dim == 'y':
+            return arr[:,index,:]
+        return arr[:,:,index]
+
+def levelFor(bins, pixels):
+    """
+    Coarsest level that still has at least one bin per screen pixel,
+    for bins visible across pixels
+    """
+    if pixels <= 0 or bins <= pixels:
+        return 0
+    return int(np.floor(np.log2(bins/float(pixels))))
@@ -0,0 +1,132 @@
+"""
+Trilinear sampling of TOPAS results at arbitrary points, lines and planes,
+and Bragg peak range extraction from depth-dose curves
+"""
+import numpy as np
+
+DIMS = ['x', 'y', 'z']
+
+def _centres(topasResults):
+    return [topasResults.X_cm_cent, topasResults.Y_cm_cent, topasResults.Z_cm_cent]
+
+def _extents(topasResults):
+    return [topasResults.X_cm_extent, topasResults.Y_cm_extent, topasResults.Z_cm_extent]
+
+def _corners(cent, coord):
+    """
+    Lower bin index and weight of the upper bin along one axis.
+    Beyond the outermost bin centres the edge bin is used as is.
+    """
+    if len(cent) == 1:
+        return np.zeros(coord.shape, dtype=np.intp), np.zeros(coord.shape)
+    index = np.clip((coord - cent[0])/((cent[-1] - cent[0])/float(len(cent) - 1)), 0, len(cent) - 1)
+    lower = np.minimum(np.floor(index).astype(np.intp), len(cent) - 2)
+    return lower, index - lower
+
+def samplePoints(topasResults, quantity, points, chunkSize=None):
+    """
+    Trilinear interpolation of topasResults.data[quantity] at points,
+    an (N,3) array of (x,y,z) in cm. Points outside the scored volume give nan.
+    chunkSize limits how many points are interpolated at once.
+    """
+    points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+    arr = topasResults.data[quantity]
+    values = np.empty(len(points))
+    chunkSize = chunkSize or max(len(points), 1)
+
+    for start in range(0, len(points), chunkSize):
+        chunk = points[start:start+chunkSize]
+        inside = np.ones(len(chunk), dtype=bool)
+        lower, weight = [], []
+        for ind,(cent,(low,high)) in enumerate(zip(_centres(topasResults), _extents(topasResults))):
+            inside &= (chunk[:,ind] >= low) & (chunk[:,ind] <= high)
+            i0, w = _corners(cent, chunk[:,ind])
+            lower.append(i0)
+            weight.append(w)
+
+        result = np.zeros(len(chunk))
+        for corner in range(8):
+            index, cornerWeight = [], 1.0
+            for ind in range(3):
+                upper = (corner >> ind) & 1
+                # a single bin axis has no upper neighbour; its weight is 0 anyway
+                index.append(np.minimum(lower[ind] + upper, arr.shape[ind] - 1))
+                cornerWeight = cornerWeight*(weight[ind] if upper else 1.0 - weight[ind])
+            result += cornerWeight*arr[index[0], index[1], index[2]]
+        result[~inside] = np.nan
+        values[start:start+chunkSize] = result
+    return values
+
+def sampleLine(topasResults, quantity, start, end, n=None, chunkSize=None):
+    """
+    Sample quantity at n equally spaced points from start to end ((x,y,z) cm).
+    By default the step is half the smallest bin size.
+    Returns (distance from start in cm, values, points).
+    """
+    start = np.asarray(start, dtype=np.float64)
+    end = np.asarray(end, dtype=np.float64)
+    length = np.linalg.norm(end - start)
+    if n is None:
+        step = 0.5*min(topasResults.header.X.size, topasResults.header.Y.size, topasResults.header.Z.size)
+        n = int(np.ceil(length/step)) + 1 if step > 0 else 2
+    t = np.linspace(0.0, 1.0, n)
+    points = start + t[:,None]*(end - start)
+    return t*length, samplePoints(topasResults, quantity, points, chunkSize), points
+
+def samplePlane(topasResults, quantity, origin, uAxis, vAxis, shape, chunkSize=None):
+    """
+    Sample quantity on a plane of any orientation: the grid spans
+    origin + s*uAxis + t*vAxis for s, t in [0, 1] (vectors in cm),
+    with shape = (nu, nv) points. Returns an (nu, nv) array.
+    """
+    origin, uAxis, vAxis = [np.asarray(vec, dtype=np.float64) for vec in (origin, uAxis, vAxis)]
+    s = np.linspace(0.0, 1.0, shape[0])
+    t = np.linspace(0.0, 1.0, shape[1])
+    points = origin + s[:,None,None]*uAxis + t[None,:,None]*vAxis
+    return samplePoints(topasResults, quantity, points.reshape(-1,3), chunkSize).reshape(shape)
+
+def depthDose(topasResults, quantity='Sum', x=None, y=None, n=None):
+    """
+    Depth-dose curve along z. With x and y (cm) the curve is sampled along
+    that beam line, otherwise it is the laterally integrated quantity per z bin.
+    Returns (z in cm, values).
+    """
+    if x is None or y is None:
+        return topasResults.Z_cm_cent, np.asarray(topasResults.data[quantity]).sum(axis=(0,1))
+    z0, z1 = topasResults.Z_cm_extent
+    distance, values, _ = sampleLine(topasResults, quantity, (x,y,z0), (x,y,z1), n)
+    return z0 + distance, values
+
+class BraggPeak:
+    """
+    Peak and distal ranges of a depth-dose curve.
+    R90, R80, R20 are the depths beyond the peak where the curve falls to
+    that fraction of its maximum (linear interpolation, nan if it never does).
+    """
+    def __init__(self, depth, dose):
+        depth = np.asarray(depth, dtype=np.float64)
+        dose = np.asarray(dose, dtype=np.float64)
+        valid = ~np.isnan(dose)
+        depth, dose = depth[valid], dose[valid]
+        peak = int(np.argmax(dose))
+        self.peakDepth = depth[peak]
+        self.peakValue = dose[peak]
+        self.R90 = _distalDepth(depth, dose, peak, 0.9)
+        self.R80 = _distalDepth(depth, dose, peak, 0.8)
+        self.R20 = _distalDepth(depth, dose, peak, 0.2)
+        self.distalFalloff = self.R20 - self.R80
+
+def _distalDepth(depth, dose, peak, fraction):
+    level = fraction*dose[peak]
+    below = np.nonzero(dose[peak:] < level)[0]
+    if len(below) == 0:
+        return np.nan
+    after = peak + below[0]
+    before = after - 1
+    return depth[before] + (dose[before] - level)/(dose[before] - dose[after])*(depth[after] - depth[before])
+
+def braggPeak(topasResults, quantity='Sum', x=None, y=None, n=None):
+    """
+    BraggPeak of the depth-dose curve, see depthDose for the arguments
+    """
+    return BraggPeak(*depthDose(topasResults, quantity, x, y, n))
@@ -0,0 +1,213 @@
+"""
+Sparse storage of TOPAS results: only non-zero voxels are kept, with their
+coordinates shared by all stats of a scorer
+"""
+import numpy as np
+
+from topasSummary import slabStep
+
+class SparseIndex:
+    """
+    Sorted flat (C order) indices of the voxels that are non-zero in any stat
+    of an [x,y,z] grid of shape
+    """
+    def __init__(self, flat, shape):
+        self.flat = np.asarray(flat, dtype=np.int64)
+        self.shape = tuple(shape)
+        self._coords = None
+
+    def coords(self):
+        """
+        (x, y, z) index arrays of the stored voxels, computed once
+        """
+        if self._coords is None:
+            self._coords = np.unravel_index(self.flat, self.shape)
+        return self._coords
+
+    def find(self, flat):
+        """
+        Position of every flat index in self.flat, and whether it is stored
+        """
+        pos = np.minimum(np.searchsorted(self.flat, flat), max(len(self.flat) - 1, 0))
+        found = self.flat[pos] == flat if len(self.flat) else np.zeros(np.shape(flat), dtype=bool)
+        return pos, found
+
+class SparseVolume:
+    """
+    [x,y,z] array of one stat in coordinate (COO) form: values of the voxels
+    in index, zero elsewhere.
+
+    Indexing with integers and slices returns a dense array of just the
+    selected region (e.g. a slice for displaySlice, or a slab), indexing with
+    integer arrays returns the voxel values. np.asarray densifies everything.
+    sum, max, min and mean reduce without densifying the grid.
+    """
+    def __init__(self, index, values):
+        self.index = index
+        self.values = np.asarray(values)
+        self.shape = index.shape
+        self.ndim = 3
+        self.size = int(np.prod(self.shape))
+        self.dtype = self.values.dtype
+
+    @property
+    def nbytes(self):
+        # the shared index is counted with every stat
+        return self.values.nbytes + self.index.flat.nbytes
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        dense = np.zeros(self.shape, dtype=dtype or self.dtype)
+        dense.flat[self.index.flat] = self.values
+        return dense
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),)*(3 - len(key))
+        if any(isinstance(k, (np.ndarray, list)) for k in key):
+            return self._points(key)
+
+        ranges, squeeze = [], []
+        for ind, k in enumerate(key):
+            if isinstance(k, slice):
+                ranges.append(range(self.shape[ind])[k])
+            else:
+                k = int(k) + (self.shape[ind] if k < 0 else 0)
+                if not 0 <= k < self.shape[ind]:
+                    raise IndexError('index {} is out of bounds for axis {}'.format(k, ind))
+                ranges.append(range(k, k + 1))
+                squeeze.append(ind)
+
+        dense = np.zeros([len(r) for r in ranges], dtype=self.dtype)
+        coords = self.index.coords()
+        select = np.ones(len(self.values), dtype=bool)
+        local = []
+        for ind, r in enumerate(ranges):
+            if len(r) == 0:
+                return dense.squeeze(axis=tuple(squeeze))
+            step = r.step
+            low, high = (r.start, r.stop) if step > 0 else (r[-1], r.start + 1)
+            c = coords[ind]
+            select &= (c >= low) & (c < high) & ((c - r.start) % step == 0)
+            local.append(c)
+        local = [(c[select] - r.start)//r.step for c, r in zip(local, ranges)]
+        dense[tuple(local)] = self.values[select]
+        return dense.squeeze(axis=tuple(squeeze))
+
+    def _points(self, key):
+        index = np.broadcast_arrays(*[np.arange(self.shape[ind])[k] for ind, k in enumerate(key)])
+        pos, found = self.index.find(np.ravel_multi_index(index, self.shape))
+        return np.where(found, self.values[pos] if len(self.values) else 0, 0).astype(self.dtype)
+
+    def _lines(self, axis):
+        """
+        Flat index of every stored voxel in the 2D grid left after removing
+        axis, the 2D shape, and the number of voxels per line along axis
+        """
+        coords = self.index.coords()
+        rest = [ind for ind in range(3) if ind != axis]
+        shape2D = (self.shape[rest[0]], self.shape[rest[1]])
+        return np.ravel_multi_index((coords[rest[0]], coords[rest[1]]), shape2D), shape2D, self.shape[axis]
+
+    def sum(self, axis=None, dtype=None, out=None):
+        if axis is None:
+            return self.values.sum(dtype=dtype)
+        flat, shape2D, _ = self._lines(axis)
+        return np.bincount(flat, weights=self.values, minlength=int(np.prod(shape2D))).reshape(shape2D).astype(dtype or np.float64)
+
+    def mean(self, axis=None, dtype=None, out=None):
+        if axis is None:
+            return self.values.sum(dtype=np.float64)/self.size
+        return self.sum(axis)/self.shape[axis]
+
+    def _extreme(self, ufunc, axis):
+        if axis is None:
+            if not len(self.values):
+                return self.dtype.type(0)
+            value = ufunc.reduce(self.values)
+            # voxels not stored are zero
+            return ufunc(value, 0) if len(self.values) < self.size else value
+        flat, shape2D, length = self._lines(axis)
+        result = np.zeros(int(np.prod(shape2D)), dtype=self.dtype)
+        stored = np.bincount(flat, minlength=len(result))
+        full = stored == length
+        # lines with every voxel stored must not include the implicit zero
+        result[full] = -np.inf if ufunc is np.maximum else np.inf
+        ufunc.at(result, flat, self.values)
+        return result.reshape(shape2D)
+
+    def max(self, axis=None, out=None):
+        return self._extreme(np.maximum, axis)
+
+    def min(self, axis=None, out=None):
+        return self._extreme(np.minimum, axis)
+
+def fromCsvBlocks(blocks, header, dtype=np.float64):
+    """
+    {stat: SparseVolume} from the blocks of readCsvBlocks; rows that are zero
+    in every stat are dropped as they are read
+    """
+    stats = header.scoredQuantity.stats
+    shape = (header.X.bins, header.Y.bins, header.Z.bins)
+    zFlip = header.Z.bins - 1
+    flats, values = [], []
+    losses = dict((stat, (0, 0)) for stat in stats)
+    for block in blocks:
+        keep = np.any(block[:,3:3+len(stats)] != 0, axis=1)
+        block = block[keep]
+        x = block[:,0].astype(np.intp)
+        y = block[:,1].astype(np.intp)
+        # same z-flip as the dense reader
+        z = zFlip - block[:,2].astype(np.intp)
+        flats.append(np.ravel_multi_index((x, y, z), shape))
+        values.append(_stored(block[:,3:3+len(stats)], dtype, stats, losses))
+    return _volumes(flats, values, stats, shape, dtype, losses)
+
+def fromArrays(arrays, dtype=None):
+    """
+    {stat: SparseVolume} of dense [x,y,z] arrays (e.g. memory mapped views)
+    on the same grid, read a few x-slices at a time
+    """
+    stats = list(arrays)
+    shape = arrays[stats[0]].shape
+    dtype = dtype or np.result_type(*[arrays[stat].dtype for stat in stats])
+    step = slabStep(shape)
+    flats, values = [], []
+    losses = dict((stat, (0, 0)) for stat in stats)
+    for start in range(0, shape[0], step):
+        slabs = [np.asarray(arrays[stat][start:start+step]) for stat in stats]
+        keep = np.zeros(slabs[0].shape, dtype=bool)
+        for slab in slabs:
+            keep |= slab != 0
+        flat = np.flatnonzero(keep)
+        flats.append(flat + start*int(np.prod(shape[1:])))
+        values.append(_stored(np.stack([slab.ravel()[flat] for slab in slabs], axis=1), dtype, stats, losses))
+    return _volumes(flats, values, stats, shape, dtype, losses)
+
+def _stored(values, dtype, stats, losses):
+    """
+    values (one column per stat) as dtype, counting what the cast loses
+    """
+    # imported here, plotting imports this module
+    from plotting import castLosses
+    stored = values.astype(dtype)
+    if stored.dtype != values.dtype:
+        for ind, stat in enumerate(stats):
+            losses[stat] = np.add(losses[stat], castLosses(values[:,ind], stored[:,ind]))
+    return stored
+
+def _volumes(flats, values, stats, shape, dtype, losses):
+    # imported here, plotting imports this module
+    from plotting import warnCastLosses
+    for stat in stats:
+        warnCastLosses(stat, dtype, losses[stat])
+    flat = np.concatenate(flats) if flats else np.zeros(0, dtype=np.int64)
+    values = np.concatenate(values) if values else np.zeros((0, len(stats)), dtype=dtype)
+    order = np.argsort(flat, kind='mergesort')
+    index = SparseIndex(flat[order], shape)
+    values = values[order]
+    return dict((stat, SparseVolume(index, np.ascontiguousarray(values[:,ind])))
+        for ind, stat in enumerate(stats))
@@ -0,0 +1,111 @@
+"""
+Streaming access to TOPAS csv scorers that are larger than memory
+"""
+import numpy as np
+
+import topasSummary
+from plotting import TopasGrid, CSV_CHUNK_BYTES, isBinaryFile, readCsvBlocks
+
+DIMS = {'x':0, 'y':1, 'z':2}
+
+class TopasStream(TopasGrid):
+    """
+    Reads the body of a topas csv file chunk by chunk instead of into full
+    [x,y,z] arrays. Peak memory is set by chunkBytes (text per chunk) plus
+    what a reduction keeps, never by the size of the file.
+
+    Has the header, param and coordinates of TopasResults, and a getSlice,
+    so displaySlice can show a slice of a file that does not fit in memory.
+
+    Args:
+        csvFile (string)
+        chunkBytes (int): approximate text size of one chunk
+    """
+
+    def __init__(self, csvFile, chunkBytes=CSV_CHUNK_BYTES):
+        if isBinaryFile(csvFile):
+            raise ValueError('Binary scorers are memory mapped, use TopasResults for {}'.format(csvFile))
+        super(TopasStream, self).__init__(csvFile)
+        self.chunkBytes = chunkBytes
+
+    def iterChunks(self, stats=None):
+        """
+        Generator of (x, y, z, values) per chunk of rows. x, y, z are the bin
+        indices (z flipped as in TopasResults), values maps stat -> 1D array.
+        """
+        allStats = self.header.scoredQuantity.stats
+        columns = [(stat, 3+allStats.index(stat)) for stat in (stats or allStats)]
+        zFlip = self.header.Z.bins - 1
+        with open(self.fileName, 'rt') as f:
+            f.seek(self.header.dataOffset)
+            for block in readCsvBlocks(f, self.chunkBytes):
+                values = dict((stat, block[:,col]) for stat,col in columns)
+                yield (block[:,0].astype(np.intp), block[:,1].astype(np.intp),
+                       zFlip - block[:,2].astype(np.intp), values)
+
+    def reduce(self, func, initial, stats=None):
+        """
+        Fold func(accumulator, x, y, z, values) over all chunks
+        """
+        acc = initial
+        for x, y, z, values in self.iterChunks(stats):
+            acc = func(acc, x, y, z, values)
+        return acc
+
+    def sliceSums(self, quantity, dim):
+        """
+        Sum of quantity over each slice perpendicular to dim
+        """
+        bins = self._bins(dim)
+        def add(acc, x, y, z, values):
+            acc += np.bincount((x,y,z)[DIMS[dim]], weights=values[quantity], minlength=bins)
+            return acc
+        return self.reduce(add, np.zeros(bins), [quantity])
+
+    def depthDose(self, quantity='Sum'):
+        """
+        Laterally integrated quantity along z; returns (Z_cm_cent, values)
+        """
+        return self.Z_cm_cent, self.sliceSums(quantity, 'z')
+
+    def sum(self, quantity):
+        return self.reduce(lambda acc,x,y,z,values: acc + values[quantity].sum(), 0.0, [quantity])
+
+    def max(self, quantity):
+        return self.reduce(lambda acc,x,y,z,values: max(acc, values[quantity].max()), -np.inf, [quantity])
+
+    def min(self, quantity):
+        return self.reduce(lambda acc,x,y,z,values: min(acc, values[quantity].min()), np.inf, [quantity])
+
+    def getSummary(self, quantity):
+        """
+        topasSummary.StatSummary of quantity, two passes over the file
+        """
+        return topasSummary.summariseStream(self, quantity)
+
+    def getSlice(self, quantity, dim, index):
+        """
+        2D array of quantity with dim fixed at bin index, in one pass over the file
+        """
+        axis = DIMS[dim]
+        plane = np.zeros([self._bins(d) for d in sorted(DIMS) if d != dim])
+        for chunk in self.iterChunks([quantity]):
+            keep = chunk[axis] == index
+            if keep.any():
+                rows, cols = [chunk[ind][keep] for ind in range(3) if ind != axis]
+                plane[rows, cols] = chunk[3][quantity][keep]
+        return plane
+
+    def toMemmap(self, quantity, fileName, dtype=np.float64):
+        """
+        Write quantity into a memory mapped [x,y,z] .npy file and return the memmap
+        """
+        shape = tuple(self._bins(dim) for dim in sorted(DIMS))
+        out = np.lib.format.open_memmap(fileName, mode='w+', dtype=dtype, shape=shape)
+        for x, y, z, values in self.iterChunks([quantity]):
+            out[x,y,z] = values[quantity]
+        out.flush()
+        return out
+
+    def _bins(self, dim):
+        return {'x':self.header.X, 'y':self.header.Y, 'z':self.header.Z}[dim].bins
@@ -0,0 +1,87 @@
+"""
+Per-stat summary index of TOPAS results: global range, percentiles and histogram
+"""
+import numpy as np
+
+SUMMARY_BINS = 1024
+SLAB_VOXELS = 1 << 22
+
+class StatSummary:
+    """
+    Global min, max, mean, count of finite and non-zero values, and a histogram
+    with fixed bins over [min, max] of one stat. Percentiles are read from the
+    histogram, so once built nothing here looks at the voxels again.
+
+    Args:
+        blocks: callable returning an iterator of 1D arrays that together hold
+            all values. It is called twice (range, then histogram), so chunked
+            or memory mapped data never has to be in memory at once.
+        bins (int): histogram bins
+    """
+    def __init__(self, blocks, bins=SUMMARY_BINS):
+        self.min, self.max = np.inf, -np.inf
+        self.count, self.nonZero, total = 0, 0, 0.0
+        for values in blocks():
+            values = values[np.isfinite(values)]
+            if values.size:
+                self.min = min(self.min, values.min())
+                self.max = max(self.max, values.max())
+                self.count += values.size
+                self.nonZero += np.count_nonzero(values)
+                total += values.sum()
+        self.mean = total/self.count if self.count else np.nan
+
+        if not self.count:
+            self.min, self.max = np.nan, np.nan
+            self.edges, self.histogram = np.zeros(bins+1), np.zeros(bins, dtype=np.int64)
+            return
+        self.edges = np.linspace(self.min, self.max, bins+1)
+        self.histogram = np.zeros(bins, dtype=np.int64)
+        scale = bins/(self.max - self.min) if self.max > self.min else 0.0
+        for values in blocks():
+            values = values[np.isfinite(values)]
+            index = np.minimum(((values - self.min)*scale).astype(np.intp), bins - 1)
+            self.histogram += np.bincount(index, minlength=bins)
+
+    def percentile(self, q):
+        """
+        Value below which q percent of the finite values lie,
+        interpolated linearly inside a histogram bin
+        """
+        if not self.count:
+            return np.nan
+        cumulative = np.concatenate([[0], np.cumsum(self.histogram)])/float(self.count)
+        return float(np.interp(q/100.0, cumulative, self.edges))
+
+    def window(self, lowPercentile, highPercentile):
+        """
+        (low, high) colour limits between two percentiles
+        """
+        return self.percentile(lowPercentile), self.percentile(highPercentile)
+
+def slabStep(shape, axis=0, slabVoxels=SLAB_VOXELS):
+    """
+    Number of slices along axis of an array of shape that hold about slabVoxels
+    voxels, at least one
+    """
+    sliceVoxels = int(np.prod([n for ind, n in enumerate(shape) if ind != axis]))
+    return max(1, slabVoxels//max(1, sliceVoxels))
+
+def slabs(arr, slabVoxels=SLAB_VOXELS):
+    """
+    blocks callable for StatSummary over an [x,y,z] array, a few x-slices at a time
+    """
+    step = slabStep(arr.shape, slabVoxels=slabVoxels)
+    def blocks():
+        for start in range(0, arr.shape[0], step):
+            yield np.asarray(arr[start:start+step], dtype=np.float64).ravel()
+    return blocks
+
+def summarise(arr, bins=SUMMARY_BINS):
+    return StatSummary(slabs(arr), bins)
+
+def summariseStream(topasStream, quantity, bins=SUMMARY_BINS):
+    """
+    StatSummary of a topasStream.TopasStream, in two passes over the file
+    """
+    return StatSummary(lambda: (values[quantity] for _,_,_,values in topasStream.iterChunks([quantity])), bins)
@@ -6,24 +6,59 @@ matplotlib.use('TkAgg')
 
 from glob import glob
 from plotting import TopasResults, displaySlice, getBin
+from topasPyramid import levelFor
+import topasProfile
 import numpy as np
 
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2
 from matplotlib.backend_bases import key_press_handler
+from matplotlib.transforms import Bbox
 
 import matplotlib.pyplot as plt
 
+import os
+import time
+import threading
+import traceback
+
 import sys
 if sys.version_info[0] < 3:
     from ttk import Tkinter as tk
     import tkFileDialog
     import ttk
+    import Queue as queue
 else:
     import tkinter as tk
     from tkinter import ttk
     from tkinter import filedialog as tkFileDialog
+    import queue
 
 DEFAULT_TOPAS_RESULTS_FOLDER = ''
+LOAD_POLL_MS = 100
+# watch mode: how often the file is checked, and how long it must stay 
+# unchanged before it is read, so a file TOPAS is still writing is left alone
+WATCH_POLL_MS = 1000
+WATCH_SETTLE_S = 2.0
+# colour windows between percentiles of the shown stat
+WINDOW_PRESETS = [  ('Full range', (0, 100)),
+                    ('0.1-99.9 %', (0.1, 99.9)),
+                    ('1-99 %', (1, 99)),
+                    ('5-95 %', (5, 95))]
+# (horizontal, vertical) dims of the image in each view
+VIEW_DIMS = {'x':('z','y'), 'y':('z','x'), 'z':('x','y')}
+
+class LoadCancelled(Exception):
+    pass
+
+def fileStamp(fileName):
+    """
+    (size, mtime) of fileName, None if it cannot be read
+    """
+    try:
+        st = os.stat(fileName)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime)
 
 class topasFrameImg:
     def __init__(self, master=None):
@@ -36,9 +71,59 @@ class topasFrameImg:
         self.fig.tight_layout()
         for view in self.axes:
             self.axes[view].img = None
+        self.backgrounds = {}
+        self.canvas.mpl_connect('draw_event', self._onDraw)
+
+    def _onDraw(self, event):
+        """
+        Slice images and slice labels are animated: a full draw leaves them out, 
+        so the background of each view can be kept for blitting. 
+        Paint them on top afterwards.
+        """
+        for view, ax in self.axes.items():
+            if ax.img is None:
+                continue
+            top = ax.sliceText.get_window_extent(event.renderer).y1
+            region = Bbox.from_extents(ax.bbox.x0, ax.bbox.y0, ax.bbox.x1, max(top, ax.bbox.y1)).padded(2)
+            self.backgrounds[view] = (region, self.canvas.copy_from_bbox(region))
+        for ax in self.axes.values():
+            if ax.img is not None:
+                ax.draw_artist(ax.img)
+                ax.draw_artist(ax.sliceText)
+
+    def splitTitle(self, view):
+        """
+        Move the last title line (the slice position set by displaySlice) into 
+        the animated sliceText, so the rest of the title stays in the background.
+        """
+        ax = self.axes[view]
+        if not hasattr(ax, 'sliceText'):
+            ax.sliceText = ax.text(0.5, 1.0, '', transform=ax.title.get_transform(), 
+                ha='center', va='baseline', fontsize=10, animated=True)
+        static, sliceLine = ax.get_title().rsplit('\n', 1)
+        ax.set_title(static + '\n', fontsize=10)
+        ax.sliceText.set_text(sliceLine)
+
+    def blit(self, view):
+        """
+        Redraw only the slice image and slice label of one view
+        """
+        if view not in self.backgrounds:
+            self.canvas.draw()
+            return
+        region, background = self.backgrounds[view]
+        ax = self.axes[view]
+        self.canvas.restore_region(background)
+        ax.draw_artist(ax.img)
+        ax.draw_artist(ax.sliceText)
+        self.canvas.blit(region)
 
 class topasResultsGUI(tk.Frame,object):
-    def __init__(self, topasFile ='', rootDir=DEFAULT_TOPAS_RESULTS_FOLDER, master=None):
+    def __init__(self, topasFile ='', rootDir=DEFAULT_TOPAS_RESULTS_FOLDER, master=None, profile=False):
+        """
+        profile=True enables topasProfile and shows the time of every load 
+        and redraw phase in the status label
+        """
         super(topasResultsGUI, self).__init__(master)
         self.grid()
         self.results = None
@@ -49,6 +134,16 @@ class topasResultsGUI(tk.Frame,object):
         self.title = 'Topas Results Viewer'
         self.master.title(self.title)
         self.topasFile = topasFile
+        self.shown = {}
+        self.shownStat = None
+        self.cbar = None
+        self.loadJob = None
+        self.watchVar = tk.BooleanVar(value=False)
+        self.watchTimer = None
+        self.loadedStamp = None
+        self.pendingStamp = None
+        self.profile = topasProfile.enable() if profile else None
+        self.loadStatus = ''
         self.create_widgets()
 
     def quit(self, *args):
@@ -67,9 +162,13 @@ class topasResultsGUI(tk.Frame,object):
         self.entryPath.bind("<Return>", (lambda event: self.entryPathReturn()))
         self.lblLoad = tk.Label(self.inputsFrame)
         self.getFileButton = tk.Button(self.inputsFrame, text="Select topas csv", command=self.getFile)
+        self.cancelButton = tk.Button(self.inputsFrame, text="Cancel", state='disabled', command=self.cancelLoad)
+        self.watchButton = tk.Checkbutton(self.inputsFrame, text="Watch", variable=self.watchVar, command=self._toggleWatch)
         self.getFileButton.grid(row=0, column=0, sticky="nsew", padx=5, pady=5)
         self.entryPath.grid(row=0, column=1, sticky="w", padx=5, pady=5)
-        self.lblLoad.grid(row=0, column=2, sticky="w", padx=5, pady=5)
+        self.cancelButton.grid(row=0, column=2, sticky="w", padx=5, pady=5)
+        self.lblLoad.grid(row=0, column=3, sticky="w", padx=5, pady=5)
+        self.watchButton.grid(row=0, column=4, sticky="w", padx=5, pady=5)
         if self.topasFile:
             self.readFile()
 
@@ -82,6 +181,11 @@ class topasResultsGUI(tk.Frame,object):
         self.toolbar = NavigationToolbar2(self.orthViews.canvas)
         self.toolbar.update()
         self.orthViews.canvas.get_tk_widget().grid(row=0, column=0, rowspan=2, columnspan=6)
+        # zooming, panning and resizing may call for another pyramid level
+        for ax in self.orthViews.axes.values():
+            ax.callbacks.connect('xlim_changed', self._onLimits)
+            ax.callbacks.connect('ylim_changed', self._onLimits)
+        self.orthViews.canvas.mpl_connect('resize_event', self._onLimits)
         # canvas.get_tk_widget().pack(side=tkinter.TOP, fill=tkinter.BOTH, expand=1)
         self.climMax = tk.Scale(
             self.viewerFrame, from_=100,to=0, resolution= 1, state='disabled', command=self._adjContrast)
@@ -93,6 +197,11 @@ class topasResultsGUI(tk.Frame,object):
         self.climMaxLabel = tk.Label(master=self.viewerFrame, text='Max').grid(row=0,column=7,sticky="s")
         self.climMax.grid(row=1,column=7,sticky="n")
         self.climMin.grid(row=1,column=6,sticky="n")
+        self.windowCbox = ttk.Combobox(master=self.viewerFrame, values=[name for name,_ in WINDOW_PRESETS], 
+            state="readonly", width=12)
+        self.windowCbox.current(0)
+        self.windowCbox.bind("<<ComboboxSelected>>", self._windowSelect)
+        self.windowCbox.grid(row=2,column=6,columnspan=2,sticky='n')
         self.orthScales = {
             'x': tk.Spinbox(self.viewerFrame, values=[''], state='disabled', command=self._updatePlot),
             'y': tk.Spinbox(self.viewerFrame, values=[''], state='disabled', command=self._updatePlot),
@@ -122,7 +231,7 @@ class topasResultsGUI(tk.Frame,object):
         self.topasFile = tkFileDialog.askopenfilename(
             title= 'Select a topas csv file',
             initialdir=self.rootDir,
-            filetypes=[('Comma-seperated values','.csv'),('All files','.*')])
+            filetypes=[('Comma-seperated values','.csv'),('TOPAS binary','.bin .binheader'),('All files','.*')])
         if self.topasFile == '':
             return 
 
@@ -130,27 +239,170 @@ class topasResultsGUI(tk.Frame,object):
         self.entryPath.insert(tk.END, self.topasFile)
         self.readFile()
 
-    def readFile(self):
+    def readFile(self, reload=False):
+        """
+        Load self.topasFile on a worker thread, so the window stays responsive.
+        A load that is still running is cancelled. Progress and the results 
+        come back through a queue that _pollLoad reads on the Tk main loop.
+        reload=True keeps the shown stat, slices and contrast (watch mode).
+        """
+        self.cancelLoad()
+        job = {'file':self.topasFile, 'cancel':threading.Event(), 'queue':queue.Queue(), 
+               'start':time.time(), 'size':None, 'stamp':fileStamp(self.topasFile),
+               'reload':reload and self.results is not None, 'stat':self.shownStat,
+               'profile':self.profile.snapshot() if self.profile else None}
+        if job['stamp']:
+            job['size'] = job['stamp'][0]
+        self.loadJob = job
+        worker = threading.Thread(target=self._loadWorker, args=(job,))
+        worker.daemon = True
+        worker.start()
+        self.lblLoad['text'] = 'Reloading...' if job['reload'] else 'Loading...'
+        self.cancelButton['state'] = 'normal'
+        self.after(LOAD_POLL_MS, self._pollLoad, job)
+
+    def cancelLoad(self):
+        if self.loadJob:
+            self.loadJob['cancel'].set()
+            self.loadJob = None
+            self.lblLoad['text'] = 'Loading cancelled'
+            self.cancelButton['state'] = 'disabled'
+
+    @staticmethod
+    def _loadWorker(job):
+        """
+        Runs on the worker thread: no Tk calls here, only the job queue
+        """
+        def progress(bytesRead, rowsRead):
+            if job['cancel'].is_set():
+                raise LoadCancelled()
+            job['queue'].put(('progress', bytesRead, rowsRead))
         try:
-            self.results = TopasResults(self.topasFile)
-            self.lblLoad['text'] = 'File read successfully'
-            self._initialisePlots()
-        except:
-            self.results = None
-            self.lblLoad['text'] = 'Error reading file'
+            # a watched file is rewritten on every update, so caching it would
+            # only write entries that are never read and evict useful ones
+            results = TopasResults(job['file'], progress=progress,
+                cacheDir='' if job['reload'] else None)
+            # the plots open on the first stat, a reload stays on the shown one
+            stat = results.header.scoredQuantity.stats[0]
+            if job['reload'] and job['stat'] in results.header.scoredQuantity.stats:
+                stat = job['stat']
+            results.data.preload([stat])
+            results.getSummary(stat)
+            results.progress = None
+            job['queue'].put(('done', results))
+        except LoadCancelled:
+            pass
+        except Exception as err:
+            traceback.print_exc()
+            job['queue'].put(('error', err))
+
+    def _pollLoad(self, job):
+        if job is not self.loadJob:
+            # cancelled or replaced by a newer load
+            return
+        while True:
+            try:
+                message = job['queue'].get_nowait()
+            except queue.Empty:
+                break
+            if message[0] == 'progress':
+                elapsed = max(time.time() - job['start'], 1e-6)
+                text = 'Loading: {:.1f}'.format(message[1]/1E6)
+                if job['size']:
+                    text += ' of {:.1f}'.format(job['size']/1E6)
+                self.lblLoad['text'] = text + ' MB, {:.2g} rows/s'.format(message[2]/elapsed)
+            else:
+                self.loadJob = None
+                self.cancelButton['state'] = 'disabled'
+                # a failed read is not retried until the file changes again
+                self.loadedStamp = job['stamp']
+                if message[0] == 'done' and job['reload'] and self._sameGrid(message[1]):
+                    self.results = message[1]
+                    self.lblLoad['text'] = 'File reloaded {}'.format(time.strftime('%H:%M:%S'))
+                    self._showProfile(job['profile'])
+                    self._swapResults()
+                elif message[0] == 'done':
+                    self.results = message[1]
+                    self.lblLoad['text'] = 'File read successfully'
+                    self._showProfile(job['profile'])
+                    self._initialisePlots()
+                elif job['reload']:
+                    # e.g. TOPAS is still writing the file: keep showing the 
+                    # previous results, the next change of the file retries
+                    self.lblLoad['text'] = 'Error reloading file {}: {}'.format(
+                        time.strftime('%H:%M:%S'), message[1])
+                else:
+                    self.results = None
+                    self.lblLoad['text'] = 'Error reading file: {}'.format(message[1])
+                return
+        self.after(LOAD_POLL_MS, self._pollLoad, job)
+
+    def _toggleWatch(self):
+        if self.watchTimer is not None:
+            self.after_cancel(self.watchTimer)
+            self.watchTimer = None
+        if self.watchVar.get():
+            self.pendingStamp = None
+            self.watchTimer = self.after(WATCH_POLL_MS, self._pollWatch)
+
+    def _pollWatch(self):
+        """
+        Watch mode: reload the file in the background once its size or mtime 
+        changed and then stayed the same for WATCH_SETTLE_S. Idle, this is 
+        one stat() call per WATCH_POLL_MS.
+        """
+        self.watchTimer = self.after(WATCH_POLL_MS, self._pollWatch)
+        if self.loadJob or not self.topasFile:
+            return
+        stamp = fileStamp(self.topasFile)
+        if stamp is None or stamp == self.loadedStamp:
+            self.pendingStamp = None
+        elif self.pendingStamp is None or self.pendingStamp[0] != stamp:
+            self.pendingStamp = (stamp, time.time())
+        elif time.time() - self.pendingStamp[1] >= WATCH_SETTLE_S:
+            self.pendingStamp = None
+            self.readFile(reload=True)
+
+    def _sameGrid(self, results):
+        """
+        True if results can replace self.results without rebuilding the plots
+        """
+        old, new = self.results.header, results.header
+        return (old.scoredQuantity.stats == new.scoredQuantity.stats and 
+            all(np.array_equal(getattr(self.results, name), getattr(results, name)) 
+                for name in ('X_cm_cent', 'Y_cm_cent', 'Z_cm_cent')))
+
+    def _swapResults(self):
+        """
+        Show the reloaded self.results in the existing images, on the same 
+        stat, slices and Min/Max contrast sliders
+        """
+        self.shown = {}
+        self.shownStat = None
+        self._updatePlot()
 
     def _initialisePlots(self):
         if self.results:
+            stat = self.results.header.scoredQuantity.stats[0]
+            self.shown = {}
+            self.shownStat = None
             for view in self.orthViews.axes:
-                self.orthViews.axes[view].img = displaySlice( 
-                    self.results, self.results.header.scoredQuantity.stats[0], 
-                    (view,None), self.orthViews.axes[view])
+                ax = self.orthViews.axes[view]
+                if ax.img is not None:
+                    ax.img.remove()
+                ax.img = displaySlice(self.results, stat, (view,None), ax)
+                ax.img.set_animated(True)
+                if hasattr(ax.img, 'set_interpolation_stage'):
+                    # pick the shown bins before colour mapping, not after: the 
+                    # same pixels, but only those are mapped (matplotlib >= 3.5)
+                    ax.img.set_interpolation_stage('data')
+                self.orthViews.splitTitle(view)
             
-            self.orthViews.fig.subplots_adjust(right=0.90)
-            self.cbar_ax = self.orthViews.fig.add_axes([0.93, 0.05, 0.01, 0.90])
-            self.orthViews.fig.colorbar(self.orthViews.axes['x'].img, cax=self.cbar_ax, format='%.1e')
-            self.cbar_ax.tick_params(labelsize=8)
-            self.orthViews.canvas.draw()
+            if self.cbar is None:
+                self.orthViews.fig.subplots_adjust(right=0.90)
+                self.cbar_ax = self.orthViews.fig.add_axes([0.93, 0.05, 0.01, 0.90])
+                self.cbar = self.orthViews.fig.colorbar(self.orthViews.axes['x'].img, cax=self.cbar_ax, format='%.1e')
+                self.cbar_ax.tick_params(labelsize=8)
             self.climMin['state'] = 'normal'
             self.climMax['state'] = 'normal'
             self.climMax.set(100)
@@ -164,31 +416,130 @@ class topasResultsGUI(tk.Frame,object):
                 
                 self.orthScales[view]['values'] = orthScalesHelper[view]
                 self.orthScales[view]['state'] = 'normal'
+                # start on the central slice shown above
+                self.orthScales[view].delete(0, tk.END)
+                self.orthScales[view].insert(0, orthScalesHelper[view][int(0.5*len(orthScalesHelper[view]))])
+            self._updatePlot()
     
     def _updatePlot(self, *args):
-        if self.statsCbox['values'] != ['']:
-            for view in self.orthViews.axes:
-                self.orthViews.axes[view].img = displaySlice( 
-                    self.results, self.statsCbox.get(), 
-                    (view,getBin(self.results, view, float(self.orthScales[view].get()))), self.orthViews.axes[view])
-            self.orthViews.fig.colorbar(self.orthViews.axes['x'].img, cax=self.cbar_ax, format='%.1e')
-            self.orthViews.canvas.draw()
+        """
+        Only views whose stat or slice changed are redrawn. A new stat needs
+        new colour limits, hence a full draw; a new slice is blitted.
+        """
+        if self.results is not None and self.statsCbox['values'] != ['']:
+            snapshot = self.profile.snapshot() if self.profile else None
+            with topasProfile.phase('viewer.update'):
+                stat = self.statsCbox.get()
+                changed = []
+                for view in self.orthViews.axes:
+                    selBin = getBin(self.results, view, float(self.orthScales[view].get()))
+                    if self._showSlice(view, stat, selBin):
+                        changed.append(view)
+                if not changed:
+                    return
+
+                if stat != self.shownStat:
+                    self.shownStat = stat
+                    self._setClim()
+                    with topasProfile.phase('viewer.draw'):
+                        self.orthViews.canvas.draw()
+                else:
+                    with topasProfile.phase('viewer.blit'):
+                        for view in changed:
+                            self.orthViews.blit(view)
+            self._showProfile(snapshot, redraw=True)
+
+    def _showProfile(self, snapshot, redraw=False):
+        """
+        With profiling on, add the phases run since snapshot to the status 
+        label: the load phases after the load message, and those of the 
+        latest redraw after them
+        """
+        if self.profile is None or snapshot is None:
+            return
+        text = self.profile.since(snapshot).summary()
+        if redraw:
+            self.lblLoad['text'] = '{} | {}'.format(self.loadStatus, text)
+        else:
+            self.loadStatus = '{}: {}'.format(self.lblLoad['text'], text)
+            self.lblLoad['text'] = self.loadStatus
     
+    def _showSlice(self, view, stat, selBin):
+        """
+        Put the slice in the image of view, at the pyramid level that suits
+        its current size and zoom. Returns False if that is already shown.
+        """
+        level = self._viewLevel(view)
+        if self.shown.get(view) == (stat, selBin, level):
+            return False
+        displaySlice(self.results, stat, (view,selBin), img=self.orthViews.axes[view].img, level=level)
+        self.orthViews.splitTitle(view)
+        self.shown[view] = (stat, selBin, level)
+        return True
+
+    def _viewLevel(self, view):
+        """
+        Coarsest pyramid level with at least one bin per screen pixel 
+        across the visible part of view, in both directions
+        """
+        ax = self.orthViews.axes[view]
+        levels = []
+        for dim, limits, pixels in zip(VIEW_DIMS[view], (ax.get_xlim(), ax.get_ylim()), (ax.bbox.width, ax.bbox.height)):
+            extent = getattr(self.results, dim.upper()+'_cm_extent')
+            visible = abs(limits[1] - limits[0])/(extent[1] - extent[0])
+            levels.append(levelFor(getattr(self.results.header, dim.upper()).bins*min(visible, 1.0), pixels))
+        return min(levels)
+
+    def _onLimits(self, *args):
+        """
+        Swap in the level matching the new zoom or size. The toolbar or resize 
+        draws the canvas afterwards, so nothing is drawn here.
+        """
+        for view, (stat, selBin, _) in list(self.shown.items()):
+            self._showSlice(view, stat, selBin)
+
+    def _setClim(self):
+        """
+        Same colour limits on all views and the colorbar: the Min/Max sliders are 
+        percentages of the global range of the stat, read from its summary index.
+        """
+        summary = self.results.getSummary(self.shownStat)
+        low, high = self.climMin.get(), self.climMax.get()
+        if low >= high:
+            low, high = 0, 100
+        span = summary.max - summary.min
+        for view in self.orthViews.axes:
+            self.orthViews.axes[view].img.set_clim(
+                [summary.min + span*low/100.0, summary.min + span*high/100.0])
+        self.cbar.update_normal(self.orthViews.axes['x'].img)
+
     def _adjContrast(self, *args):
-        if self.climMin.get() < self.climMax.get():
-            for view in self.orthViews.axes:
-                    imgMax = self.orthViews.axes[view].img.get_array().max()
-                    self.orthViews.axes[view].img.set_clim(
-                        [imgMax*self.climMin.get()/100.0, imgMax*self.climMax.get()/100.0]
-                        )
-            self.orthViews.canvas.draw()        
+        if self.results and self.shownStat and self.climMin.get() < self.climMax.get():
+            self._setClim()
+            self.orthViews.canvas.draw()
+
+    def _windowSelect(self, *args):
+        """
+        Move the Min/Max sliders to the percentiles of the selected window preset
+        """
+        if not (self.results and self.shownStat):
+            return
+        summary = self.results.getSummary(self.shownStat)
+        span = summary.max - summary.min
+        low, high = dict(WINDOW_PRESETS)[self.windowCbox.get()]
+        if span > 0:
+            low = 100.0*(summary.percentile(low) - summary.min)/span
+            high = 100.0*(summary.percentile(high) - summary.min)/span
+        self.climMax.set(100)
+        self.climMin.set(int(np.floor(low)))
+        self.climMax.set(int(np.ceil(high)))
 
 
 # run the GUI
-def main():
+def main(profile=False):
     root =tk.Tk()
-    view= topasResultsGUI(master=root)
+    view= topasResultsGUI(master=root, profile=profile)
     view.mainloop()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main('--profile' in sys.argv[1:])
\ No newline at end of file